@@ -0,0 +1,300 @@
+"""SQLite storage for parsed GEDCOM data. The individuals, families, child links and spouse links are streamed into
+an indexed database in batches, and the date ordering, bigamy, sibling marriage and duplicate user stories are answered
+with SQL queries that return the same messages as CheckForErrors. The database file can be reopened without parsing"""
+import argparse
+import datetime
+import sqlite3
+from GedcomProject import AnalyzeGEDCOM, Family, Individual
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS individuals (seq INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, name TEXT, sex TEXT,
+                                        birt INTEGER, deat INTEGER, famc TEXT);
+CREATE TABLE IF NOT EXISTS families (seq INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, marr INTEGER, div INTEGER,
+                                     husb TEXT, wife TEXT);
+CREATE TABLE IF NOT EXISTS children (seq INTEGER PRIMARY KEY, fam TEXT NOT NULL, indi TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS spouses (seq INTEGER PRIMARY KEY, indi TEXT NOT NULL, fam TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS parse_errors (seq INTEGER PRIMARY KEY, message TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS individuals_name_birt ON individuals (name, birt);
+CREATE INDEX IF NOT EXISTS individuals_birt ON individuals (birt);
+CREATE INDEX IF NOT EXISTS individuals_deat ON individuals (deat);
+CREATE INDEX IF NOT EXISTS families_marr ON families (marr);
+CREATE INDEX IF NOT EXISTS families_div ON families (div);
+CREATE INDEX IF NOT EXISTS families_husb ON families (husb);
+CREATE INDEX IF NOT EXISTS families_wife ON families (wife);
+CREATE INDEX IF NOT EXISTS children_fam ON children (fam, indi);
+CREATE INDEX IF NOT EXISTS children_indi ON children (indi);
+CREATE INDEX IF NOT EXISTS spouses_indi ON spouses (indi, fam);
+CREATE INDEX IF NOT EXISTS spouses_fam ON spouses (fam);
+"""
+
+#every family with the names of both spouses, the missing parent of a single parent family is named "unknown" like in CheckForErrors
+COUPLES = """SELECT f.seq, f.id, f.marr, f.div, f.husb, f.wife, CASE WHEN f.husb IS NULL THEN 'unknown' ELSE h.name END AS husb_name,
+                    CASE WHEN f.wife IS NULL THEN 'unknown' ELSE w.name END AS wife_name, h.birt AS husb_birt, w.birt AS wife_birt
+             FROM families f LEFT JOIN individuals h ON h.id = f.husb LEFT JOIN individuals w ON w.id = f.wife"""
+
+def ordinal(date):
+    """Dates are stored as their ordinal so they compare as integers"""
+    return None if date == None else date.toordinal()
+
+def from_ordinal(number):
+    return None if number == None else datetime.date.fromordinal(number)
+
+
+class GedcomDatabase:
+    """This class stores parsed GEDCOM data in SQLite and runs user stories as SQL queries"""
+    #Key = story ID Value = method answering it, in the order CheckForErrors runs them
+    RULES = {"US01": "dates_before_curr", "US02": "indi_birth_before_marriage", "US03": "birth_before_death",
+             "US04": "marr_before_div", "US11": "no_bigamy", "US18": "no_marriage_to_siblings",
+             "US23": "unique_names_and_bdays", "US24": "unique_spouses_in_family", "US25": "unique_children_in_family"}
+
+    def __init__(self, db_name):
+        """Opens (or creates) the database file, use ":memory:" for a database that is not saved"""
+        self.connection = sqlite3.connect(db_name)
+        self.connection.executescript(SCHEMA)
+
+    @classmethod
+    def from_gedcom(cls, file_name, db_name, batch_size = 10000):
+        """Parses the GEDCOM file into a new database batch_size records at a time, the whole tree is never in memory"""
+        database = cls(db_name)
+        database.stream(file_name, batch_size)
+        return database
+
+    def stream(self, file_name, batch_size = 10000):
+        """Parses the GEDCOM file straight into the database in a single transaction, replacing whatever it held before"""
+        with self.connection:
+            self.clear()
+            StreamingLoad(file_name, self, batch_size)
+
+    def clear(self):
+        for table in ("individuals", "families", "children", "spouses", "parse_errors"):
+            self.connection.execute("DELETE FROM {}".format(table))
+
+    def load(self, individuals, family, errors = ()):
+        """Bulk loads the parsed dictionaries from AnalyzeGEDCOM with batched inserts in a single transaction,
+           replacing whatever the database held before"""
+        with self.connection:
+            self.clear()
+            self.connection.executemany("INSERT INTO individuals (id, name, sex, birt, deat, famc) VALUES (?, ?, ?, ?, ?, ?)",
+                                        ((ID, indi.name, indi.sex, ordinal(indi.birt), ordinal(indi.deat), indi.famc)
+                                         for ID, indi in individuals.items()))
+            self.connection.executemany("INSERT INTO families (id, marr, div, husb, wife) VALUES (?, ?, ?, ?, ?)",
+                                        ((ID, ordinal(fam.marr), ordinal(fam.div), fam.husb, fam.wife) for ID, fam in family.items()))
+            self.connection.executemany("INSERT INTO children (fam, indi) VALUES (?, ?)",
+                                        ((ID, child) for ID, fam in family.items() for child in sorted(fam.chil)))
+            self.connection.executemany("INSERT INTO spouses (indi, fam) VALUES (?, ?)",
+                                        ((ID, fam) for ID, indi in individuals.items() for fam in sorted(indi.fams)))
+            self.connection.executemany("INSERT INTO parse_errors (message) VALUES (?)", ((error,) for error in errors))
+
+    def close(self):
+        self.connection.close()
+
+    def query(self, sql, parameters = ()):
+        return self.connection.execute(sql, parameters).fetchall()
+
+    def check_for_errors(self, stories = None, as_of = None):
+        """Returns the errors found while parsing followed by the messages of the requested stories (all if stories is None).
+           as_of is the date treated as the current date, today if not given"""
+        if stories is not None:
+            unknown = set(stories) - set(self.RULES)
+            if unknown:
+                raise ValueError("User stories not supported by the database: {}".format(", ".join(sorted(unknown))))
+        self.as_of = datetime.date.today() if as_of == None else as_of
+        all_errors = [message for message, in self.query("SELECT message FROM parse_errors ORDER BY seq")]
+        for story, method in self.RULES.items():
+            if stories is None or story in stories:
+                all_errors += getattr(self, method)()
+        return all_errors
+
+    def dates_before_curr(self):
+        """US01: Tests to ensure any dates do not occur after current date"""
+        as_of = self.as_of.toordinal()
+        errors = []
+        for kind, column in (("marriage", "marr"), ("divorce", "div")):
+            for husb, wife in self.query("SELECT husb_name, wife_name FROM ({}) WHERE {} > ? ORDER BY seq".format(COUPLES, column), (as_of,)):
+                errors += ["US01: The {} of {} and {} cannot occur after the current date.".format(kind, husb, wife)]
+        for kind, column in (("birth", "birt"), ("death", "deat")):
+            for name, in self.query("SELECT name FROM individuals WHERE {} > ? ORDER BY seq".format(column), (as_of,)):
+                errors += ["US01: The {} of {} cannot occur after the current date.".format(kind, name)]
+        return errors
+
+    def indi_birth_before_marriage(self):
+        """US02: Tests to ensure a married individual was not born after their marriage"""
+        errors = []
+        for husb, wife, husb_late, wife_late in self.query("""SELECT husb_name, wife_name, husb_birt > marr, wife_birt > marr FROM ({})
+                                                              WHERE husb_birt > marr OR wife_birt > marr ORDER BY seq""".format(COUPLES)):
+            late = [name for name, is_late in ((husb, husb_late), (wife, wife_late)) if is_late]
+            errors += ["US02: " + " and ".join("{}'s birth can not occur after their date of marriage".format(name) for name in late)]
+        return errors
+
+    def birth_before_death(self):
+        """US03: Tests to ensure that birth occurs before the death of an individual"""
+        return ["US03: {}'s death can not occur before their date of birth".format(name)
+                for name, in self.query("SELECT name FROM individuals WHERE deat < birt ORDER BY seq")]
+
+    def marr_before_div(self):
+        """US04: Tests to ensure that marriage dates come before divorce dates"""
+        return ["US04: {} and {}'s divorce can not occur before their date of marriage".format(husb, wife)
+                for husb, wife in self.query("SELECT husb_name, wife_name FROM ({}) WHERE div < marr ORDER BY seq".format(COUPLES))]
+
+    def no_bigamy(self):
+        """US11: Tests to ensure marriage does not occur during marriage with someone else. Each spouse's families are taken in
+           order of their IDs and a marriage is bigamous if the previous one never ended in divorce or ended after it started.
+           Like CheckForErrors, a wife is only checked through a family whose husband is not a spouse in exactly one family"""
+        rows = self.query("""WITH ordered AS (
+                                 SELECT s.indi, f.marr, LAG(f.marr) OVER w AS prev_marr, LAG(f.div) OVER w AS prev_div,
+                                        ROW_NUMBER() OVER w AS n
+                                 FROM spouses s JOIN families f ON f.id = s.fam
+                                 WINDOW w AS (PARTITION BY s.indi ORDER BY s.fam))
+                             SELECT i.name FROM ordered o JOIN individuals i ON i.id = o.indi
+                             WHERE o.n > 1 AND (o.prev_div IS NULL OR (o.marr > o.prev_marr AND o.marr < o.prev_div))
+                               AND (EXISTS (SELECT 1 FROM families f WHERE f.husb = o.indi)
+                                    OR EXISTS (SELECT 1 FROM families f WHERE f.wife = o.indi
+                                               AND (SELECT COUNT(*) FROM spouses x WHERE x.indi = f.husb) != 1))
+                             GROUP BY i.name ORDER BY MIN(i.seq)""")
+        return ["US11: {} is practing bigamy".format(name) for name, in rows]
+
+    def no_marriage_to_siblings(self):
+        """US18: Tests to ensure that individuals do not marry their siblings"""
+        errors, couples = [], set()
+        for name, sibling in self.query("""SELECT p.name, o.name FROM individuals p
+                                           JOIN spouses s ON s.indi = p.id JOIN families f ON f.id = s.fam
+                                           JOIN individuals o ON o.id IN (f.husb, f.wife) AND o.id != p.id
+                                           JOIN children c ON c.fam = p.famc AND c.indi = o.id
+                                           ORDER BY p.seq, s.fam"""):
+            if (sibling, name) not in couples and (name, sibling) not in couples:
+                errors += ["US18: {} cannot be married to their sibling {}".format(name, sibling)]
+                couples.add((name, sibling))
+        return errors
+
+    def unique_names_and_bdays(self):
+        """US23: Tests to ensure there are no individuals with the same name and birthdate"""
+        rows = self.query("""SELECT name, birt FROM (SELECT seq, name, birt, ROW_NUMBER() OVER (PARTITION BY name, birt ORDER BY seq) AS n
+                                                     FROM individuals WHERE birt IS NOT NULL) WHERE n > 1 ORDER BY seq""")
+        return ["US23: An idividual with the name: {}, and birthday: {}, already exists!".format(name, from_ordinal(birt)) for name, birt in rows]
+
+    def unique_spouses_in_family(self):
+        """US24: Checks to see if only one family has spouses with the same names and marriage dates"""
+        rows = self.query("""SELECT husb_name, wife_name, marr FROM (
+                                 SELECT seq, husb_name, wife_name, marr,
+                                        ROW_NUMBER() OVER (PARTITION BY husb_name, wife_name, marr ORDER BY seq) AS n FROM ({})
+                                 WHERE husb IS NOT NULL AND wife IS NOT NULL)
+                             WHERE n > 1 ORDER BY seq""".format(COUPLES))
+        return ["US24: The family with spouses {} and {} married on {} occurs more than once in the GEDCOM file.".format(husb, wife, from_ordinal(marr))
+                for husb, wife, marr in rows]
+
+    def unique_children_in_family(self):
+        """US25: Checks to make sure that each child in a family has a unique name and birthdate"""
+        rows = self.query("""SELECT name, birt, fam FROM (
+                                 SELECT c.seq, c.fam, i.name, i.birt,
+                                        ROW_NUMBER() OVER (PARTITION BY c.fam, i.name, i.birt ORDER BY c.seq) AS n
+                                 FROM children c JOIN individuals i ON i.id = c.indi WHERE i.birt IS NOT NULL)
+                             WHERE n > 1 ORDER BY seq""")
+        return ["US25: There is more than one child with the name {} and birthdate {} in family {}".format(name, from_ordinal(birt), fam)
+                for name, birt, fam in rows]
+
+
+class StreamingLoad(AnalyzeGEDCOM):
+    """Parses a GEDCOM file straight into a GedcomDatabase: the parser only holds the records of the current batch and
+       inserts them with executemany every batch_size records. Duplicate IDs and family names in date messages are looked
+       up in the database, and the pointers are checked with SQL once every record is stored"""
+    def __init__(self, file_name, database, batch_size):
+        self.database = database
+        self.batch_size = batch_size
+        super(StreamingLoad, self).__init__(file_name, create_tables = False, print_errors = False, stories = set())
+
+    def new_individual(self, indiv):
+        """The previous record is complete when a new one starts, so the batch is stored here once it is full"""
+        if len(self.individuals) + len(self.family) >= self.batch_size:
+            self.flush()
+        if indiv not in self.individuals:
+            rows = self.database.query("SELECT name, sex, birt, deat, famc FROM individuals WHERE id = ?", (indiv,))
+            if rows:                #a duplicate of a stored individual, its lines are added to the stored one
+                indi = self.individuals[indiv] = Individual()
+                indi.name, indi.sex, birt, deat, indi.famc = rows[0]
+                indi.birt, indi.deat = from_ordinal(birt), from_ordinal(deat)
+        return super(StreamingLoad, self).new_individual(indiv)
+
+    def new_family(self, fam):
+        if len(self.individuals) + len(self.family) >= self.batch_size:
+            self.flush()
+        if fam not in self.family:
+            rows = self.database.query("SELECT marr, div, husb, wife FROM families WHERE id = ?", (fam,))
+            if rows:
+                family = self.family[fam] = Family()
+                marr, div, family.husb, family.wife = rows[0]
+                family.marr, family.div = from_ordinal(marr), from_ordinal(div)
+        return super(StreamingLoad, self).new_family(fam)
+
+    def spouse_name(self, ID):
+        if ID in self.individuals:
+            return self.individuals[ID].name
+        rows = self.database.query("SELECT name FROM individuals WHERE id = ?", (ID,))
+        return rows[0][0] if rows else ID
+
+    def flush(self):
+        """Inserts or updates the records of the batch and stores the messages found so far, then empties the batch"""
+        connection = self.database.connection
+        connection.executemany("""INSERT INTO individuals (id, name, sex, birt, deat, famc) VALUES (?, ?, ?, ?, ?, ?)
+                                  ON CONFLICT (id) DO UPDATE SET name = excluded.name, sex = excluded.sex, birt = excluded.birt,
+                                                                 deat = excluded.deat, famc = excluded.famc""",
+                               ((ID, indi.name, indi.sex, ordinal(indi.birt), ordinal(indi.deat), indi.famc) for ID, indi in self.individuals.items()))
+        connection.executemany("""INSERT INTO families (id, marr, div, husb, wife) VALUES (?, ?, ?, ?, ?)
+                                  ON CONFLICT (id) DO UPDATE SET marr = excluded.marr, div = excluded.div, husb = excluded.husb, wife = excluded.wife""",
+                               ((ID, ordinal(fam.marr), ordinal(fam.div), fam.husb, fam.wife) for ID, fam in self.family.items()))
+        connection.executemany("INSERT INTO children (fam, indi) VALUES (?, ?)",
+                               ((ID, child) for ID, fam in self.family.items() for child in sorted(fam.chil)))
+        connection.executemany("INSERT INTO spouses (indi, fam) VALUES (?, ?)",
+                               ((ID, fam) for ID, indi in self.individuals.items() for fam in sorted(indi.fams)))
+        connection.executemany("INSERT INTO parse_errors (message) VALUES (?)", ((error,) for error in self.errors))
+        self.individuals.clear()
+        self.family.clear()
+        del self.errors[:]
+
+    def finish_analysis(self):
+        """Stores the last batch, then reports the missing birth dates (US27) and the dangling pointers (US26)
+           and drops those pointers like AnalyzeGEDCOM.check_references"""
+        self.flush()
+        self.ages = dict()
+        database, connection = self.database, self.database.connection
+        for table, columns in (("children", "fam, indi"), ("spouses", "indi, fam")):  #links repeated by duplicate records
+            connection.execute("DELETE FROM {0} WHERE seq NOT IN (SELECT MIN(seq) FROM {0} GROUP BY {1})".format(table, columns))
+        self.errors += [Individual.AGE_ERROR.format(name) for name, in database.query("SELECT name FROM individuals WHERE birt IS NULL ORDER BY seq")]
+        for role, column in (("husband", "husb"), ("wife", "wife")):
+            missing = "{0} IS NOT NULL AND {0} NOT IN (SELECT id FROM individuals)".format(column)
+            self.errors += ["US26: The {} {} of family {} does not exist".format(role, spouse, ID)
+                            for ID, spouse in database.query("SELECT id, {} FROM families WHERE {} ORDER BY seq".format(column, missing))]
+            connection.execute("UPDATE families SET {} = NULL WHERE {}".format(column, missing))
+        missing = "indi NOT IN (SELECT id FROM individuals)"
+        self.errors += ["US26: The child {} of family {} does not exist".format(child, ID)
+                        for ID, child in database.query("SELECT fam, indi FROM children WHERE {} ORDER BY fam, indi".format(missing))]
+        connection.execute("DELETE FROM children WHERE {}".format(missing))
+        missing = "famc IS NOT NULL AND famc NOT IN (SELECT id FROM families)"
+        self.errors += ["US26: The family {} that {} is a child in does not exist".format(fam, ID)
+                        for ID, fam in database.query("SELECT id, famc FROM individuals WHERE {} ORDER BY seq".format(missing))]
+        connection.execute("UPDATE individuals SET famc = NULL WHERE {}".format(missing))
+        missing = "fam NOT IN (SELECT id FROM families)"
+        self.errors += ["US26: The family {} that {} is a spouse in does not exist".format(fam, ID)
+                        for ID, fam in database.query("SELECT indi, fam FROM spouses WHERE {} ORDER BY indi, fam".format(missing))]
+        connection.execute("DELETE FROM spouses WHERE {}".format(missing))
+        self.flush()
+
+
+def main():
+    """This method loads a GEDCOM file into a database, or checks a database that was loaded before"""
+    parser = argparse.ArgumentParser(description = "Loads GEDCOM files into SQLite and checks them with SQL")
+    parser.add_argument("database")
+    parser.add_argument("--load", metavar = "GEDCOM", help = "parse this GEDCOM file into the database first")
+    parser.add_argument("--stories", help = "comma separated user stories to check, all supported ones by default")
+    parser.add_argument("--as-of", type = datetime.date.fromisoformat, help = "YYYY-MM-DD date treated as the current date, today by default")
+    args = parser.parse_args()
+    if args.load:
+        database = GedcomDatabase.from_gedcom(args.load, args.database)
+    else:
+        database = GedcomDatabase(args.database)
+    stories = None if args.stories is None else set(args.stories.split(","))
+    for error in sorted(database.check_for_errors(stories, args.as_of)):
+        print(error)
+    database.close()
+
+if __name__ == '__main__':
+    main()
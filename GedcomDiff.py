@@ -0,0 +1,244 @@
+"""Structural diff between two versions of a GEDCOM file. Both files are streamed one record at a time and every
+0 @ID@ record is reduced to a hash of its lines, where the hash of a line covers its tag, its value and the sorted hashes
+of the lines under it. The order of the lines is ignored but not which line a value is under, and memory use is
+proportional to the number of records and not to the size of the files. Only the modified records are read again for
+field changes"""
+import argparse
+import hashlib
+from collections import Counter, defaultdict
+from GedcomExtract import GedcomExtract
+from GedcomProject import AnalyzeGEDCOM, read_records
+
+def digest(text):
+    """Hash of a text, the same in every run"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size = 16).digest()
+
+def record_fields(lines):
+    """Returns the level 1 lines of a record as (digest, fields) pairs. The fields are (path, value) pairs for the line and
+       every line under it, the path joins the tags from level 1 down, e.g. ("BIRT.DATE", "8 FEB 1969")"""
+    groups, fields, stack = [], [], []      #stack holds [tag, value, digests of the lines under it] from level 1 down to the current line
+    for line in lines[1:]:
+        parts = line.split(" ", 2)
+        try:
+            level = int(parts[0])
+            parts = parts[1:]
+        except ValueError:
+            level = len(stack) + 1          #a line without a level is kept under the current one
+            parts = line.split(" ", 1)
+        level = max(1, min(level, len(stack) + 1))  #a level jump is kept under the current line
+        close_lines(stack, level, groups, fields)
+        if level == 1:
+            fields = []
+        tag, value = parts[0] if parts else "", parts[1] if len(parts) > 1 else ""
+        stack.append([tag, value, []])
+        fields.append((".".join(entry[0] for entry in stack), value))
+    close_lines(stack, 1, groups, fields)
+    return groups
+
+def close_lines(stack, level, groups, fields):
+    """Takes the lines at level and below off the stack. The digest of each one is added to the line above it, or to
+       groups with the fields of the level 1 line"""
+    while len(stack) >= level:
+        tag, value, digests = stack.pop()
+        line_digest = digest("{}\t{}\t{}".format(tag, value, "".join(sorted(child.hex() for child in digests))))
+        if stack:
+            stack[-1][2].append(line_digest)
+        else:
+            groups.append((line_digest, tuple(fields)))
+
+def record_digest(digests):
+    """Hash of the level 1 line digests that does not depend on their order"""
+    return digest("".join(sorted(line_digest.hex() for line_digest in digests)))
+
+def record_references(groups):
+    """Returns the IDs the record points to (FAMS, FAMC, HUSB, WIFE, CHIL, ...)"""
+    return {value.strip("@") for line_digest, fields in groups for path, value in fields
+            if value.startswith("@") and value.endswith("@") and len(value) > 2}
+
+#Key = record tag Value = paths of the values US23 (individuals) and US24 (families) compare records on
+IDENTITY_PATHS = {"INDI": ("NAME", "BIRT.DATE"), "FAM": ("HUSB", "WIFE", "MARR.DATE")}
+
+def record_identity(tag, groups, identity = None):
+    """Returns the values of the record's IDENTITY_PATHS, None for a missing one, updating the identity of an earlier
+       record with the same ID. The last line wins like in AnalyzeGEDCOM"""
+    if tag not in IDENTITY_PATHS:
+        return None
+    values = dict(zip(IDENTITY_PATHS[tag], identity if identity != None else [None] * len(IDENTITY_PATHS[tag])))
+    for line_digest, fields in groups:
+        for path, value in fields:
+            if path in values and value != "":
+                values[path] = value
+    return tuple(values[path] for path in IDENTITY_PATHS[tag])
+
+def summarize(file_name):
+    """Streams the file and returns Key = ID Value = (record tag, digest, set of referenced IDs, identity) for every record
+       with an ID, see record_identity. A record whose ID appears more than once is treated as one record with the lines
+       of all of them, so adding or removing a duplicate ID (US22) modifies the record"""
+    records = dict()
+    for ID, tag, lines in read_records(file_name):
+        if ID == None:
+            continue
+        groups = record_fields(lines)
+        digests = [line_digest for line_digest, fields in groups]
+        if ID in records:
+            old_tag, old_digest, references, identity = records[ID]
+            records[ID] = (old_tag, record_digest([old_digest] + digests), references | record_references(groups),
+                           record_identity(old_tag, groups, identity))
+        else:
+            records[ID] = (tag, record_digest(digests), record_references(groups), record_identity(tag, groups))
+    return records
+
+def date_key(value):
+    """Returns the date AnalyzeGEDCOM reads a DATE value as, None if it leaves the date out"""
+    date = AnalyzeGEDCOM.parse_date(value)
+    return date if date != None else AnalyzeGEDCOM.nearest_date(value)
+
+def duplicate_keys(records):
+    """Returns Key = ID Value = the key US23 compares an individual with a birth date on, or the key US24 compares
+       a family with both spouses on"""
+    keys = dict()
+    for ID, (tag, digest, references, identity) in records.items():
+        if tag == "INDI" and identity[1] != None and date_key(identity[1]) != None:
+            keys[ID] = ("INDI", identity[0], date_key(identity[1]))
+        elif tag == "FAM" and identity[0] != None and identity[1] != None:
+            spouses = [records.get(spouse.strip("@")) for spouse in identity[:2]]
+            if all(spouse != None and spouse[0] == "INDI" for spouse in spouses):
+                marr = date_key(identity[2]) if identity[2] != None else None
+                keys[ID] = ("FAM", spouses[0][3][0], spouses[1][3][0], marr)
+    return keys
+
+def collisions(old_keys, new_keys):
+    """Returns the IDs of the new file's records that share their US23 or US24 key with a record whose key changed and
+       with at least one other record in either file, their errors can change although they did not change"""
+    changed = {key for ID in set(old_keys) | set(new_keys) if old_keys.get(ID) != new_keys.get(ID)
+               for key in (old_keys.get(ID), new_keys.get(ID)) if key != None}
+    old_count, new_count = Counter(old_keys.values()), Counter(new_keys.values())
+    return {ID for ID, key in new_keys.items() if key in changed and (old_count[key] > 1 or new_count[key] > 1)}
+
+
+class GedcomDiff:
+    """This class compares two versions of a GEDCOM file and reports the added, removed and modified records"""
+    def __init__(self, old_file, new_file):
+        self.old_file = old_file
+        self.new_file = new_file
+        old, new = summarize(old_file), summarize(new_file)
+        self.added = {ID: new[ID][0] for ID in new if ID not in old}            #Key = ID Value = record tag (INDI, FAM, ...)
+        self.removed = {ID: old[ID][0] for ID in old if ID not in new}
+        self.modified = {ID: new[ID][0] for ID in new if ID in old and old[ID][1] != new[ID][1]}
+        self.old_references = {ID: old[ID][2] for ID in self.removed}
+        self.new_references = {ID: record[2] for ID, record in new.items()}
+        self.colliding = collisions(duplicate_keys(old), duplicate_keys(new))  #unchanged records US23 and US24 compare with changed ones
+        self.tree = None            #GedcomExtract relationship maps of the new file, read when the affected records are needed
+        self.changes = self.field_changes()
+
+    def field_changes(self):
+        """Reads only the modified records again and returns Key = ID Value = (removed lines, added lines), each line is
+           a level 1 line given as the (path, value) fields of the line and the lines under it"""
+        old_groups, new_groups = defaultdict(list), defaultdict(list)
+        for file_name, groups in ((self.old_file, old_groups), (self.new_file, new_groups)):
+            for ID, tag, lines in read_records(file_name):
+                if ID in self.modified:
+                    groups[ID] += record_fields(lines)
+        changes = dict()
+        for ID in self.modified:
+            fields = dict(old_groups[ID] + new_groups[ID])          #Key = line digest Value = fields of the line
+            old = Counter(line_digest for line_digest, line_fields in old_groups[ID])
+            new = Counter(line_digest for line_digest, line_fields in new_groups[ID])
+            changes[ID] = (sorted(fields[line] for line in (old - new).elements()), sorted(fields[line] for line in (new - old).elements()))
+        return changes
+
+    def affected(self, stories = None):
+        """Returns the IDs of the new file's records whose checks can change: the added and modified records, the records
+           that pointed to a removed one and the records that now have or used to have the same name and birth date (US23)
+           or spouses and marriage date (US24) as a changed one, with the relatives the user stories compare them with.
+           Spouses, parents, siblings and children are always included, grandparents only for US19 and US20 and
+           descendants only for US17"""
+        referrers = defaultdict(set)
+        for ID, references in self.new_references.items():
+            for reference in references:
+                referrers[reference].add(ID)
+        seeds = set(self.added) | set(self.modified) | self.colliding
+        for ID, references in self.old_references.items():
+            seeds |= (references | referrers[ID]) & set(self.new_references)
+        tree = self.load_tree()
+        people = set()
+        for ID in seeds:                            #a changed family changes the checks of its spouses and children
+            if tree.types.get(ID) == "FAM":
+                people |= tree.spouses[ID] | tree.children[ID]
+            elif tree.types.get(ID) == "INDI":
+                people.add(ID)
+        people = {ID for ID in people if tree.types.get(ID) == "INDI"}
+        affected = seeds | self.relatives(people)
+        if stories == None or {"US19", "US20"} & set(stories):    #cousins, aunts and uncles share a grandparent
+            spouses = {spouse for ID in people for fam in tree.spouse_families[ID] for spouse in tree.spouses[fam]}
+            affected |= tree.ancestors({ID for ID in people | spouses if tree.types.get(ID) == "INDI"}, 2)
+        if stories == None or "US17" in stories:    #a marriage to a descendant
+            affected |= tree.descendants(people, set(), None, False)
+        return {ID for ID in affected if ID in self.new_references}
+
+    def load_tree(self):
+        """Returns the relationship maps of the new file, they only hold IDs and are read once"""
+        if self.tree == None:
+            self.tree = GedcomExtract(self.new_file)
+        return self.tree
+
+    def relatives(self, people):
+        """Returns the people with their families, spouses, parents, siblings and children"""
+        tree = self.load_tree()
+        found = set(people)
+        for ID in people:
+            for fam in tree.parent_families[ID] | tree.spouse_families[ID]:
+                found |= {fam} | tree.spouses[fam] | tree.children[fam]
+        return found
+
+    def context(self, affected):
+        """Returns the records that have to be read to check the affected ones: the people in their families and every
+           family of those people, so nobody checked looks unmarried or orphaned because a record was not read"""
+        tree = self.load_tree()
+        people = {ID for ID in affected if tree.types.get(ID) == "INDI"}
+        for fam in affected - people:
+            people |= tree.spouses[fam] | tree.children[fam]
+        read = affected | self.relatives(people)
+        for ID in list(read):
+            read |= tree.parent_families[ID] | tree.spouse_families[ID]
+        return {ID for ID in read if ID in self.new_references}
+
+    def revalidate(self, stories = None):
+        """Checks only the affected records of the new file, reading the records around them too, and returns their
+           errors, errors of records that did not change can be reused from the previous run. Pointers to IDs that
+           are in no record are asked for too so they are still reported as dangling (US26)"""
+        affected = self.affected(stories)
+        records = self.context(affected)
+        records |= {reference for ID in records for reference in self.new_references[ID] if reference not in self.new_references}
+        return AnalyzeGEDCOM(self.new_file, create_tables = False, print_errors = False, stories = stories, records = records,
+                             subjects = affected).all_errors
+
+    def report(self):
+        """Returns the lines of a readable summary of the differences"""
+        lines = []
+        for title, records in (("Added", self.added), ("Removed", self.removed), ("Modified", self.modified)):
+            for ID in sorted(records):
+                lines += ["{} {} {}".format(title, records[ID], ID)]
+                if ID in self.changes:
+                    removed, added = self.changes[ID]
+                    lines += ["    - {} {}".format(path, value).rstrip() for line in removed for path, value in line]
+                    lines += ["    + {} {}".format(path, value).rstrip() for line in added for path, value in line]
+        return lines if lines else ["The files have the same records"]
+
+
+def main():
+    """This method prints the differences between two GEDCOM files"""
+    parser = argparse.ArgumentParser(description = "Shows the records that changed between two GEDCOM files")
+    parser.add_argument("old_file")
+    parser.add_argument("new_file")
+    parser.add_argument("--revalidate", action = "store_true", help = "also check the records affected by the changes")
+    args = parser.parse_args()
+    diff = GedcomDiff(args.old_file, args.new_file)
+    for line in diff.report():
+        print(line)
+    if args.revalidate:
+        for error in sorted(diff.revalidate()):
+            print(error)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""Extracts the ancestors or descendants of some individuals or couples from a GEDCOM file into a standalone GEDCOM file.
+The file is streamed twice: once to build the relationship maps, which only hold IDs, and once to copy the reachable
+INDI and FAM records (and the SOUR, NOTE, ... records they point to) with pointers to left out records removed"""
+import argparse
+import sys
+from collections import defaultdict, deque
+from GedcomProject import read_records
+
+RELATIONSHIP_TAGS = {"FAMC", "FAMS", "HUSB", "WIFE", "CHIL"}
+
+def pointer(value):
+    """Returns the ID of a @ID@ argument, None if the argument is not a pointer"""
+    if len(value) > 2 and value[0] == "@" and value[-1] == "@":
+        return value[1:-1]
+    return None
+
+
+class GedcomExtract:
+    """This class holds the relationship maps of a GEDCOM file and writes the records reachable from some roots"""
+    DIRECTIONS = ("ancestors", "descendants", "both")
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.types = dict()                         #Key = ID Value = record tag (INDI, FAM, SOUR, ...)
+        self.parent_families = defaultdict(set)     #Key = IndiID Value = set of FamIDs they are a child in
+        self.spouse_families = defaultdict(set)     #Key = IndiID Value = set of FamIDs they are a spouse in
+        self.spouses = defaultdict(set)             #Key = FamID Value = set of spouse IDs
+        self.children = defaultdict(set)            #Key = FamID Value = set of children IDs
+        self.other_references = defaultdict(set)    #Key = ID Value = set of IDs pointed to by anything but the relationship tags
+        for ID, tag, lines in read_records(file_name):
+            if ID == None and tag != "HEAD":
+                continue
+            if ID != None:
+                self.types[ID] = tag
+            for line in lines[1:]:
+                parts = line.split(" ", 2)
+                if len(parts) < 3 or pointer(parts[2]) == None:
+                    continue
+                target = pointer(parts[2])
+                if ID == None or parts[0] != "1" or parts[1] not in RELATIONSHIP_TAGS:
+                    self.other_references[ID].add(target)   #Key None holds the records HEAD points to, e.g. SUBM
+                elif parts[1] == "FAMC":
+                    self.parent_families[ID].add(target)
+                elif parts[1] == "FAMS":
+                    self.spouse_families[ID].add(target)
+                elif parts[1] == "CHIL":
+                    self.children[ID].add(target)
+                    self.parent_families[target].add(ID)
+                else:                               #HUSB and WIFE
+                    self.spouses[ID].add(target)
+                    self.spouse_families[target].add(ID)
+        for indi, families in list(self.parent_families.items()):    #FAMC and CHIL may each be missing on one side
+            for fam in families:
+                if self.types.get(fam) == "FAM":
+                    self.children[fam].add(indi)
+        for indi, families in list(self.spouse_families.items()):
+            for fam in families:
+                if self.types.get(fam) == "FAM":
+                    self.spouses[fam].add(indi)
+
+    def reachable(self, roots, direction = "descendants", depth = None, include_spouses = True):
+        """Returns the set of INDI and FAM IDs reachable from the root individuals or families. depth limits the number of
+           generations followed, None follows every generation"""
+        if direction not in self.DIRECTIONS:
+            raise ValueError("The direction must be one of {}".format(", ".join(self.DIRECTIONS)))
+        for root in roots:
+            if self.types.get(root) not in ("INDI", "FAM"):
+                raise KeyError("There is no individual or family with the ID {}".format(root))
+        people = {root for root in roots if self.types[root] == "INDI"}
+        couples = {root for root in roots if self.types[root] == "FAM"}
+        found = set(people) | couples
+        for fam in couples:
+            found |= self.spouses[fam]
+        if direction in ("ancestors", "both"):
+            found |= self.ancestors(found - couples, depth)
+        if direction in ("descendants", "both"):
+            found |= self.descendants(people, couples, depth, include_spouses)
+        return {ID for ID in found if self.types.get(ID) in ("INDI", "FAM")}
+
+    def ancestors(self, people, depth):
+        """Breadth first search up the tree: the parent families of every individual and the parents in them"""
+        found, queue = set(people), deque((ID, 0) for ID in people)
+        while queue:
+            ID, generation = queue.popleft()
+            if depth != None and generation >= depth:
+                continue
+            for fam in self.parent_families[ID]:
+                found.add(fam)
+                for parent in self.spouses[fam]:
+                    if parent not in found:
+                        found.add(parent)
+                        queue.append((parent, generation + 1))
+        return found
+
+    def descendants(self, people, couples, depth, include_spouses):
+        """Breadth first search down the tree: the spouse families of every individual, their spouses if include_spouses
+           is True, and the children in them. The root couples start at generation 0 like the root individuals"""
+        found = set(people) | set(couples)
+        queue = deque([("FAM", fam, 0) for fam in couples] + [("INDI", ID, 0) for ID in people])
+        while queue:
+            tag, ID, generation = queue.popleft()
+            if tag == "INDI":
+                for fam in self.spouse_families[ID] - found:
+                    found.add(fam)
+                    queue.append(("FAM", fam, generation))
+                continue
+            if include_spouses:
+                found |= self.spouses[ID]
+            if depth != None and generation >= depth:
+                continue
+            for child in self.children[ID] - found:
+                found.add(child)
+                queue.append(("INDI", child, generation + 1))
+        return found
+
+    def write(self, IDs, output):
+        """Streams the file again and writes a GEDCOM file holding the HEAD record, the given INDI and FAM records and the other
+           records they or HEAD point to. Lines pointing to records that are left out are removed together with the lines under them"""
+        keep = set(IDs)
+        stack = [ID for ID in keep if self.other_references.get(ID)] + [None]
+        while stack:                                #SOUR, NOTE, SUBM... records pointed to by HEAD or kept records, and what they point to
+            for target in self.other_references.get(stack.pop(), ()):
+                if target not in keep and self.types.get(target) not in (None, "INDI", "FAM"):
+                    keep.add(target)
+                    stack.append(target)
+        wrote_head = False
+        for ID, tag, lines in read_records(self.file_name):
+            if ID == None and tag == "HEAD":
+                output.write("\n".join(self.filter_pointers(lines, keep)) + "\n")
+                wrote_head = True
+            elif ID in keep:
+                if not wrote_head:
+                    output.write("0 HEAD\n")
+                    wrote_head = True
+                output.write("\n".join(self.filter_pointers(lines, keep)) + "\n")
+        if not wrote_head:
+            output.write("0 HEAD\n")
+        output.write("0 TRLR\n")
+
+    @staticmethod
+    def filter_pointers(lines, keep):
+        """Yields the lines of a record without the lines pointing to records that are not kept, and the lines under those"""
+        skip_below = None
+        for line in lines:
+            parts = line.split(" ", 2)
+            level = int(parts[0]) if parts[0].isdigit() else None
+            if skip_below != None and level != None and level > skip_below:
+                continue
+            skip_below = None
+            target = pointer(parts[2]) if len(parts) == 3 and level != 0 else None
+            if target != None and target not in keep:
+                skip_below = level
+                continue
+            yield line
+
+
+def extract(file_name, output_name, roots, direction = "descendants", depth = None, include_spouses = True):
+    """Writes the records reachable from the roots into output_name and returns the set of INDI and FAM IDs written"""
+    extractor = GedcomExtract(file_name)
+    IDs = extractor.reachable(roots, direction, depth, include_spouses)
+    with open(output_name, "w") as output:
+        extractor.write(IDs, output)
+    return IDs
+
+def main():
+    """This method extracts a branch of a GEDCOM file"""
+    parser = argparse.ArgumentParser(description = "Extracts the ancestors or descendants of individuals or couples into a new GEDCOM file")
+    parser.add_argument("file_name")
+    parser.add_argument("roots", nargs = "+", help = "IDs of the root individuals or families, e.g. I1 F2")
+    parser.add_argument("-o", "--output", help = "file to write, the standard output by default")
+    parser.add_argument("--direction", choices = GedcomExtract.DIRECTIONS, default = "descendants")
+    parser.add_argument("--depth", type = int, default = None, help = "number of generations to follow, all by default")
+    parser.add_argument("--no-spouses", action = "store_true", help = "leave out the spouses of descendants")
+    args = parser.parse_args()
+    extractor = GedcomExtract(args.file_name)
+    IDs = extractor.reachable([root.replace("@", "") for root in args.roots], args.direction, args.depth, not args.no_spouses)
+    if args.output:
+        with open(args.output, "w") as output:
+            extractor.write(IDs, output)
+    else:
+        extractor.write(IDs, sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -1,127 +1,242 @@
 from prettytable import PrettyTable
+from bisect import bisect_left, bisect_right
+import calendar
 import datetime
-from collections import defaultdict
-from copy import deepcopy
+from collections import Counter, defaultdict, namedtuple
+from collections.abc import Mapping
 import os
 
 class AnalyzeGEDCOM:
     """This class analyzes the GEDCOM file and sorts information into the family and individual classes respectively for analysis"""
-    def __init__(self, file_name, create_tables = True, print_errors = True):
+    def __init__(self, file_name, create_tables = True, print_errors = True, stories = None, records = None, as_of = None,
+                 max_errors = None, limits = None, fail_fast = False, subjects = None):
         self.file_name = file_name
+        self.as_of = as_of if as_of != None else datetime.date.today()    #the "current date" of the run, fixed once so runs can be repeated
+        self.records = records      #set of the only INDI/FAM IDs to read from the file, None reads every record
+        self.subjects = subjects    #set of the only INDI/FAM IDs the user stories check, the other records read are only looked up
         self.family = dict()        #dictionary with Key = FamID Value = Family class object
         self.individuals = dict()   #dictionary with Key = IndiID Value = Individual class object
-        self.toRemove = []          #list of keys to be removed because of invalid dates
         self.errors = []
+        self.malformed_lines = 0    #number of lines that could not be parsed, the rest of their record is skipped
+        self.malformed_samples = [] #(line number, text) of the first MALFORMED_SAMPLES malformed lines
         self.fam_table = PrettyTable(field_names = ["ID", "Married", "Divorced", "Husband ID", "Husband Name", "Wife ID", "Wife Name", "Children"])
         self.indi_table = PrettyTable(field_names = ["ID", "Name", "Gender", "Birthday", "Age", "Alive", "Death", "Child", "Spouse"])
         self.analyze()
         if create_tables:           #allows to easily toggle the print of the pretty table on and off
             self.create_pretty_tables()
-        self.all_errors = CheckForErrors(self.individuals, self.family, self.errors, print_errors).all_errors
+        checker = CheckForErrors(self.individuals, self.family, self.errors, print_errors, stories, self.as_of, max_errors, limits, fail_fast, self.ages,
+                                 self.subjects)
+        self.all_errors = checker.all_errors
+        self.budget_exhausted = checker.budget_exhausted    #True if a budgeted run stopped before running every rule
+
+    #Key = (record type, parent tag, tag) Value = (method storing the line's argument, attribute it is stored in)
+    #the parent tag is the tag of the closest line one level up, None for level 1 lines
+    DISPATCH = {
+        ("INDI", None, "NAME"): ("set_value", "name"),
+        ("INDI", None, "SEX"): ("set_value", "sex"),
+        ("INDI", None, "FAMC"): ("set_xref", "famc"),
+        ("INDI", None, "FAMS"): ("add_xref", "fams"),
+        ("INDI", "BIRT", "DATE"): ("set_date", "birt"),
+        ("INDI", "DEAT", "DATE"): ("set_date", "deat"),
+        ("FAM", None, "HUSB"): ("set_xref", "husb"),
+        ("FAM", None, "WIFE"): ("set_xref", "wife"),
+        ("FAM", None, "CHIL"): ("add_xref", "chil"),
+        ("FAM", "MARR", "DATE"): ("set_date", "marr"),
+        ("FAM", "DIV", "DATE"): ("set_date", "div"),
+    }
+    EVENTS = {"INDI": ["BIRT", "DEAT"], "FAM": ["MARR", "DIV"]}
+    for record_type, events in EVENTS.items():
+        for parent in events:
+            DISPATCH[(record_type, parent, "PLAC")] = ("set_place", parent)
+        for parent in [None] + events:
+            DISPATCH[(record_type, parent, "NOTE")] = ("add_text", "notes")
+            DISPATCH[(record_type, parent, "SOUR")] = ("add_text", "sources")
+        for parent, attribute in (("NOTE", "notes"), ("SOUR", "sources")):
+            DISPATCH[(record_type, parent, "CONT")] = ("continue_text", attribute)
+            DISPATCH[(record_type, parent, "CONC")] = ("concatenate_text", attribute)
+    del record_type, events, parent, attribute
+    MONTHS = {"JAN": 1, "FEB": 2, "MAR": 3, "APR": 4, "MAY": 5, "JUN": 6, "JUL": 7, "AUG": 8, "SEP": 9, "OCT": 10, "NOV": 11, "DEC": 12}
+    #US42 messages for each date attribute, individuals are named by their name and families by the names of both spouses
+    DATE_ERRORS = {"birt": "US42: {} is an illegitimate date for {}'s birthday.",
+                   "deat": "US42: {} is an illegitimate date for {}'s death.",
+                   "marr": "US42: {} is an illegitimate date for {}'s and {}'s marriage.",
+                   "div": "US42: {} is an illegitimate date for {}'s and {}'s divorce."}
+    DATE_ADJUSTED = " The date has been adjusted to the nearest valid date."
+    DATE_LEFT_OUT = " The date could not be read and was left out."
+    MALFORMED_SAMPLES = 10
 
     def analyze(self):
-        """This method reads in each line and determines if a new family or individual need to be made, if not then it sends the line
-           to be analyzed further in analyze_info"""
-        indiv, fam, previous_line, current_type = "", "", [], 0
+        """This method reads in each line and determines if a new family or individual need to be made, if not then it looks up
+           the handler for the line in DISPATCH using the record type, the parent tag and the line's tag"""
+        dispatch = {key: (getattr(self, method), attribute) for key, (method, attribute) in self.DISPATCH.items()}
+        record, record_type, tags = None, None, []      #tags is the context stack: tags[n] is the tag of the latest level n line
+        stored = []                                     #stored[n] is True if the latest level n line was stored
         read_GEDCOM_file = self.read_files(self.file_name, error_mess = "A misformatted line was found!", seperator = " " )
-        for line in read_GEDCOM_file:                                       #Reads each line from the generator
-            if line[0] == '0' and line[1] in ["HEAD", "TRLR", "NOTE"]:      #These cases provide no information we need to analyze
+        for number, line in enumerate(read_GEDCOM_file, 1):                 #Reads each line from the generator
+            if line[0] == '0':
+                record_type = None
+                if len(line) > 1 and line[1] in ["HEAD", "TRLR", "NOTE"]:   #These cases provide no information we need to analyze
+                    continue
+                elif len(line) < 3:
+                    self.add_malformed(number, line)                        #a record without an ID or a type, its lines are skipped
+                    continue
+                elif self.records != None and line[1].replace("@", "") not in self.records:
+                    continue                                                #The record was not asked for, skip its lines
+                elif line[2] == "INDI":
+                    record_type, tags, stored = "INDI", ["INDI"], [True]    #Marker used to ensure following lines are analyzed as individual
+                    record = self.new_individual(line[1].replace("@", ""))  #The GEDCOM file from online has @ID@ format, this replaces it
+                elif line[2] == "FAM":
+                    record_type, tags, stored = "FAM", ["FAM"], [True]      #Marker used to ensure following lines are analyzed as family
+                    record = self.new_family(line[1].replace("@", ""))
                 continue
-            elif line[0] == '0' and line [2] == "INDI":
-                current_type = 1                                            #Marker used to ensure following lines are analyzed as individual
-                indiv = line[1].replace("@", "")                            #The GEDCOM file from online has @ID@ format, this replaces it
-                if indiv in self.individuals.keys():                        #If there is a duplicate ID report it
-                    self.errors += ["US22: The individual ID: {}, already exists, this ID is not unique".format(indiv)]
-                else:
-                    self.individuals[indiv] = Individual()                  #The instance of a Individual class object is created
+            if record_type == None:
                 continue
-            elif line[0] == '0' and line[2] == "FAM":
-                current_type = 2                                            #Marker used to ensure following lines are analyzed as family
-                fam = line[1].replace("@", "")
-                if fam in self.family.keys():                               #If there is a duplicate ID report it
-                    self.errors += ["US22: The family ID: {}, already exists, this ID is not unique".format(fam)]
-                else:
-                    self.family[fam] = Family()                             #The instance of a Family class object is created
+            try:
+                level, tag = int(line[0]), line[1]
+            except (ValueError, IndexError):                                #no level or no tag
+                if line != [""]:                                            #blank lines are skipped
+                    self.add_malformed(number, line)
+                    record_type = None                                      #resynchronize at the next level 0 line
                 continue
-            if current_type in [1,2]:                                       #No new Individual or Family was created, analyze line further
-                self.analyze_info(line, previous_line, indiv, fam, current_type)
-            previous_line = line
-        for indiv in self.individuals.values():
-            indiv.update_age()
-        for element in self.toRemove:
-            if(element[0] == "I" and element in self.individuals):
-                self.individuals.pop(element)
-            elif(element[0] == "F" and element in self.family):
-                self.family.pop(element)
-                
-    def analyze_info(self, line, previous_line, idn, fam, current_type):
-        """This analyzes each line's information and stores it in the appropriate place in the appropriate class"""
-        if len(line) == 2:
-            return      #We only need this line when it becomes the previous line
+            if not 0 < level <= len(tags):                                  #a level jump, the line's parent is unknown
+                self.add_malformed(number, line)
+                record_type = None
+                continue
+            parent = tags[level - 1] if level > 1 else None
+            tags[level:] = [tag]
+            handler = dispatch.get((record_type, parent, tag))
+            if tag in ("CONT", "CONC") and not stored[level - 1]:
+                handler = None                                              #continues a NOTE or SOUR that was not stored, e.g. under NAME
+            stored[level:] = [handler != None]
+            if handler != None:
+                method, attribute = handler
+                if len(line) == 3:
+                    method(record, attribute, line[2])
+                elif method == self.add_text:                               #a NOTE or SOUR without text, its CONT and CONC lines go in it
+                    method(record, attribute, "")
+        self.finish_analysis()
+
+    def new_individual(self, indiv):
+        """Returns the Individual a level 0 INDI line starts, a duplicate ID is reported and adds its lines to the first one"""
+        if indiv in self.individuals:                               #If there is a duplicate ID report it
+            self.errors += ["US22: The individual ID: {}, already exists, this ID is not unique".format(indiv)]
         else:
-            #Populates the variables in the Individuals class and Family class
-            level, tag, arg = line
-            level = int(level)
-            if level == 1 and tag in ["NAME", "SEX", "FAMC", "FAMS", "HUSB", "WIFE", "CHIL"]:
-                arg = arg.replace("@", "")
-                if current_type == 1:                      #individual analysis
-                    if tag == "FAMS":
-                        self.individuals[idn].fams.add(arg)
-                    elif tag == "NAME":
-                        self.individuals[idn].name = arg
-                    elif tag == "SEX":
-                        self.individuals[idn].sex = arg
-                    elif tag == "FAMC":
-                        self.individuals[idn].famc = arg
-                elif current_type == 2:                     #family analysis
-                    if tag == "HUSB":
-                        self.family[fam].husb = arg
-                    elif tag == "WIFE":
-                        self.family[fam].wife = arg
-                    elif tag == "CHIL":
-                        self.family[fam].chil.add(arg)
-            elif level == 2 and tag == "DATE":              #Handles dates for both INDI and FAM cases
-                p_level, p_tag = previous_line
-                validDate = False
-                
-                try: 
-                    arg = datetime.datetime.strptime(arg, "%d %b %Y").date()
-                    validDate = True
-                except: 
-                    if p_tag == "BIRT":
-                        self.errors+=["US42: {} is an illegitimate date for {}'s birthday. The date has been adjusted to the nearest valid date.".format(arg,self.individuals[idn].name)]
-                    elif p_tag == "DEAT":
-                        self.errors+=["US42: {} is an illegitimate date for {}'s death. The date has been adjusted to the nearest valid date.".format(arg,self.individuals[idn].name)]
-                    elif p_tag == "MARR":
-                        self.errors+=["US42: {} is an illegitimate date for {}'s and {}'s marriage. The date has been adjusted to the nearest valid date.".format(arg,self.individuals[self.family[fam].husb].name,self.individuals[self.family[fam].wife].name)]
-                    elif p_tag == "DIV":
-                        self.errors+=["US42: {} is an illegitimate date for {}'s and {}'s divorce. The date has been adjusted to the nearest valid date.".format(arg,self.individuals[self.family[fam].husb].name,self.individuals[self.family[fam].wife].name)]
-                            
-                        
-                while(validDate == False):
-                    try: 
-                        arg = datetime.datetime.strptime(arg, "%d %b %Y").date()
-                        validDate = True
-                    except:                     #handles invalid dates. If a date is invalid it is added to error list 
-                                                #and the date is corrected to nearest valid date to allow program to continue running
-                        if(int(arg.split()[0]) <= 0):
-                            arg = str(int(arg.split()[0]) + 1) + " " + arg.split()[1] + " " + arg.split()[2]
-                        else:
-                            arg = str(int(arg.split()[0]) - 1) + " " + arg.split()[1] + " " + arg.split()[2]
-                        
-                    
-                if p_level == "1" and p_tag in ["BIRT", "DEAT", "MARR", "DIV"]:
-                    if current_type == 1:                   #individual analysis
-                        if p_tag == "BIRT":
-                            self.individuals[idn].birt = arg
-                        elif p_tag == "DEAT":
-                            self.individuals[idn].deat = arg
-                    elif current_type == 2:                 #family analysis
-                        if p_tag == "MARR":
-                            self.family[fam].marr = arg
-                        elif p_tag == "DIV":
-                            self.family[fam].div = arg
+            self.individuals[indiv] = Individual()                  #The instance of a Individual class object is created
+        return self.individuals[indiv]
+
+    def new_family(self, fam):
+        """Returns the Family a level 0 FAM line starts, a duplicate ID is reported and adds its lines to the first one"""
+        if fam in self.family:                                      #If there is a duplicate ID report it
+            self.errors += ["US22: The family ID: {}, already exists, this ID is not unique".format(fam)]
+        else:
+            self.family[fam] = Family()                             #The instance of a Family class object is created
+        return self.family[fam]
+
+    def spouse_name(self, ID):
+        """Returns the name of an individual read so far to name a family in a message, the ID if they were not read yet"""
+        return self.individuals[ID].name if ID in self.individuals else ID
+
+    def finish_analysis(self):
+        """Computes the ages and checks the pointers once every record is read"""
+        self.ages = age_index(self.individuals, self.as_of)                 #exact ages on as_of, computed once and shared with the checks
+        for ID, indiv in self.individuals.items():
+            indiv.alive = indiv.deat == None
+            if ID in self.ages:
+                indiv.age = self.ages[ID].calendar_years
+            else:                                                           #the individual is kept, the checks skip the missing dates
+                self.errors += [Individual.AGE_ERROR.format(indiv.name)]
+        self.check_references()
+
+    def add_malformed(self, number, line):
+        """Counts a line that could not be parsed and keeps the first few as samples"""
+        self.malformed_lines += 1
+        if len(self.malformed_samples) < self.MALFORMED_SAMPLES:
+            self.malformed_samples += [(number, " ".join(line))]
+
+    def check_references(self):
+        """US26: Reports pointers to records that do not exist instead of failing later, the dangling pointers are dropped.
+           Every record is kept, a family with one parent keeps None for the other like a family without a HUSB or WIFE line.
+           When only some records are read, pointers to records that were not asked for are dropped without a message"""
+        for ID, fam in self.family.items():
+            for role, attribute in (("husband", "husb"), ("wife", "wife")):
+                spouse = getattr(fam, attribute)
+                if spouse != None and spouse not in self.individuals:
+                    self.add_dangling("US26: The {} {} of family {} does not exist".format(role, spouse, ID), spouse)
+                    setattr(fam, attribute, None)
+            for child in sorted(child for child in fam.chil if child not in self.individuals):
+                self.add_dangling("US26: The child {} of family {} does not exist".format(child, ID), child)
+                fam.chil.discard(child)
+        for ID, indi in self.individuals.items():
+            if indi.famc != None and indi.famc not in self.family:
+                self.add_dangling("US26: The family {} that {} is a child in does not exist".format(indi.famc, ID), indi.famc)
+                indi.famc = None
+            for fam in sorted(fam for fam in indi.fams if fam not in self.family):
+                self.add_dangling("US26: The family {} that {} is a spouse in does not exist".format(fam, ID), fam)
+                indi.fams.discard(fam)
+
+    def add_dangling(self, error, target):
+        """Reports a dangling pointer unless its target was left out on purpose"""
+        if self.records == None or target in self.records:
+            self.errors += [error]
 
+    def set_value(self, record, attribute, arg):
+        setattr(record, attribute, arg)
+
+    def set_xref(self, record, attribute, arg):
+        setattr(record, attribute, arg.replace("@", ""))
+
+    def add_xref(self, record, attribute, arg):
+        getattr(record, attribute).add(arg.replace("@", ""))
+
+    def set_place(self, record, event, arg):
+        record.places[event] = arg
+
+    def add_text(self, record, attribute, arg):
+        getattr(record, attribute).append(arg.replace("@", "") if arg.startswith("@") else arg)
+
+    def continue_text(self, record, attribute, arg):
+        """CONT continues the last note or source on a new line"""
+        getattr(record, attribute)[-1] += "\n" + arg
+
+    def concatenate_text(self, record, attribute, arg):
+        """CONC continues the last note or source on the same line"""
+        getattr(record, attribute)[-1] += arg
+
+    def set_date(self, record, attribute, arg):
+        """Stores a date, invalid dates are added to the error list and corrected to the nearest valid date.
+           Dates that cannot be corrected by moving the day, e.g. a bad month or a partial date, are left out"""
+        date = self.parse_date(arg)
+        if date == None:
+            if isinstance(record, Family):
+                names = [self.spouse_name(ID) for ID in (record.husb, record.wife)]
+            else:
+                names = [record.name]
+            date = self.nearest_date(arg)
+            self.errors += [self.DATE_ERRORS[attribute].format(arg, *names) + (self.DATE_LEFT_OUT if date == None else self.DATE_ADJUSTED)]
+        setattr(record, attribute, date)
+
+    @classmethod
+    def nearest_date(cls, arg):
+        """Returns the valid date closest to an invalid "DD MON YYYY" argument by moving the day to the nearest day of the month,
+           None if the month or the year is not valid"""
+        try:
+            day, month, year = arg.split()
+            day, year = int(day), int(year)
+        except ValueError:
+            return None
+        if month.upper() not in cls.MONTHS or not datetime.MINYEAR <= year <= datetime.MAXYEAR:
+            return None
+        month = cls.MONTHS[month.upper()]
+        return datetime.date(year, month, min(max(day, 1), calendar.monthrange(year, month)[1]))
+
+    @classmethod
+    def parse_date(cls, arg):
+        """Returns the date of a "DD MON YYYY" argument, None if it is not a valid date"""
+        try:
+            day, month, year = arg.split()
+            return datetime.date(int(year), cls.MONTHS[month.upper()], int(day))
+        except (ValueError, KeyError):
+            return None
 
     def create_pretty_tables(self):
         """Populates the pretty tables with all necessary summary information"""
@@ -131,13 +246,19 @@ class AnalyzeGEDCOM:
         print(self.indi_table)
         print("Family Table")
         for ID, fam in self.family.items():
-            self.fam_table.add_row([ID, fam.marr, fam.div, fam.husb, self.individuals[fam.husb].name, fam.wife, self.individuals[fam.wife].name, fam.chil])
+            husb_name, wife_name = [self.individuals[spouse].name if spouse != None else None for spouse in (fam.husb, fam.wife)]
+            self.fam_table.add_row([ID, fam.marr, fam.div, fam.husb, husb_name, fam.wife, wife_name, fam.chil])
         print(self.fam_table)
 
+    def build_indexes(self):
+        """Builds the optional secondary indexes for name and date range queries, call it after analyze()"""
+        self.index = TreeIndex(self.individuals, self.family)
+        return self.index
+
     def read_files(self, file_name, error_mess, seperator = "\t"):
             """A generic read file generator to check bad file inputs and read line by line"""
             try:
-                fp = open(file_name, 'r')
+                fp = open(file_name, 'r', errors = "replace")   #undecodable bytes must not stop the run
             except FileNotFoundError:
                 raise FileNotFoundError ("Could not open {}".format(file_name))
             else:
@@ -155,10 +276,15 @@ class Family:
         self.husb = None #husband ID
         self.wife = None #wife ID
         self.chil = set() #set of children
+        self.places = dict() #Key = event tag (MARR, DIV) Value = place
+        self.notes = [] #list of notes
+        self.sources = [] #list of source IDs or source texts
 
 
 class Individual:
     """This class stores all the pertinent information about an individual"""
+    AGE_ERROR = "US27: Improper records of birth/death for {}, need proper birth/death date to calculate age"
+
     def __init__(self):
         """This captures all the relevant information for an individual, it also instantiates null values in case information is incomplete"""
         self.name = None
@@ -169,118 +295,620 @@ class Individual:
         self.deat = None
         self.famc = None
         self.fams = set()
+        self.places = dict()    #Key = event tag (BIRT, DEAT) Value = place
+        self.notes = []
+        self.sources = []       #list of source IDs or source texts
 
-    def update_age(self):
-        """Checks to see if INDI is dead, and finds their age"""
+    def update_age(self, as_of = None):
+        """Checks to see if INDI is dead, and finds their age in the year of as_of (today if not given) like age_index does"""
         self.alive = self.deat == None
-        try:
-            if self.alive:
-                self.age = datetime.datetime.today().year - self.birt.year
-            else:
-                self.age = self.deat.year - self.birt.year
-        except AttributeError:
-            raise AttributeError("US27: Improper records of birth/death for {}, need proper birth/death date to calculate age".format(self.name))
+        if self.birt == None:
+            raise AttributeError(self.AGE_ERROR.format(self.name))
+        self.age = exact_age(self.birt, self.deat if self.deat != None else (as_of if as_of != None else datetime.date.today())).calendar_years
+
+class TreeIndex:
+    """Sorted secondary indexes over the parsed individuals and families, so name and date range queries
+       are answered with a dictionary lookup or a bisect instead of a scan of every record"""
+    def __init__(self, individuals, family):
+        self.births = self.date_index(individuals, "birt")      #(sorted list of date ordinals, list of matching IDs)
+        self.deaths = self.date_index(individuals, "deat")
+        self.marriages = self.date_index(family, "marr")
+        self.marriage_days = DayOfYearIndex((ID, fam.marr) for ID, fam in family.items() if fam.marr != None)
+        self.birth_days = DayOfYearIndex((ID, indi.birt) for ID, indi in individuals.items() if indi.birt != None and indi.deat == None)
+        self.death_days = DayOfYearIndex((ID, indi.deat) for ID, indi in individuals.items() if indi.deat != None)
+        self.surnames = defaultdict(list)                       #Key = normalized surname Value = sorted list of IndiIDs
+        for ID in sorted(individuals):
+            surname = self.surname(individuals[ID].name)
+            if surname is not None:
+                self.surnames[surname].append(ID)
+
+    @staticmethod
+    def date_index(records, attribute):
+        """Returns the ordinals of the given date attribute sorted, and the IDs in the same order, records without the date are left out"""
+        pairs = sorted((getattr(record, attribute).toordinal(), ID) for ID, record in records.items() if getattr(record, attribute) != None)
+        return [ordinal for ordinal, ID in pairs], [ID for ordinal, ID in pairs]
+
+    @staticmethod
+    def surname(name):
+        """Returns the normalized surname from the /Surname/ part of a NAME, None if there is no surname"""
+        if name == None or name.count("/") < 2:
+            return None
+        surname = " ".join(name.split("/")[1].split()).casefold()
+        return surname if surname else None
+
+    @staticmethod
+    def between(index, start, end):
+        """Yields the IDs whose date is from start to end (both included), a start or end of None leaves that side open"""
+        ordinals, IDs = index
+        low = 0 if start == None else bisect_left(ordinals, start.toordinal())
+        high = len(ordinals) if end == None else bisect_right(ordinals, end.toordinal())
+        return (IDs[i] for i in range(low, high))
+
+    def born_between(self, start, end):
+        """Yields the IDs of the individuals born from start to end"""
+        return self.between(self.births, start, end)
+
+    def died_between(self, start, end):
+        """Yields the IDs of the individuals who died from start to end"""
+        return self.between(self.deaths, start, end)
+
+    def married_between(self, start, end):
+        """Yields the IDs of the families married from start to end"""
+        return self.between(self.marriages, start, end)
+
+    def born_in(self, year):
+        """Yields the IDs of the individuals born in the year"""
+        return self.born_between(datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+
+    def died_in(self, year):
+        """Yields the IDs of the individuals who died in the year"""
+        return self.died_between(datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+
+    def married_in(self, year):
+        """Yields the IDs of the families married in the year"""
+        return self.married_between(datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+
+    def with_surname(self, surname):
+        """Yields the IDs of the individuals with the surname, ignoring case and extra spaces"""
+        return iter(self.surnames.get(" ".join(surname.strip("/").split()).casefold(), []))
+
+    def upcoming_anniversaries(self, date, days):
+        """Yields (FamID, anniversary date) for the marriage anniversaries from date to days after it"""
+        return self.marriage_days.within(date, days)
+
+    def upcoming_birthdays(self, date, days):
+        """Yields (IndiID, birthday) for the birthdays of living individuals from date to days after it"""
+        return self.birth_days.within(date, days)
+
+    def upcoming_death_anniversaries(self, date, days):
+        """Yields (IndiID, anniversary date) for the anniversaries of deaths from date to days after it"""
+        return self.death_days.within(date, days)
+
+
+class DayOfYearIndex:
+    """Index of yearly recurring events (birthdays, anniversaries) sorted by day of the year, so the events in a window
+       of days are found with two bisects per calendar year the window touches. Days are counted in a leap year so
+       29 FEB has its own day, in other years it is celebrated on 28 FEB"""
+    LEAP_YEAR = 2000
+
+    def __init__(self, events):
+        """events is an iterable of (ID, date)"""
+        entries = sorted((self.day_of_year(date), ID, date) for ID, date in events)
+        self.days = [day for day, ID, date in entries]
+        self.events = [(ID, date) for day, ID, date in entries]
+
+    @classmethod
+    def day_of_year(cls, date):
+        """Returns the day of the year (1 to 366) of the date's month and day in a leap year"""
+        return datetime.date(cls.LEAP_YEAR, date.month, date.day).timetuple().tm_yday
+
+    @staticmethod
+    def is_leap(year):
+        return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+    def within(self, date, days):
+        """Yields (ID, date of the occurrence) for every event that recurs from date to days after it (both included),
+           ordered by the occurrence. Events are only reported once and not before the original event happened"""
+        if days < 0:
+            raise ValueError("The window can not be a negative number of days")
+        end = date + datetime.timedelta(days = days)
+        seen = set()
+        while date <= end:
+            year_end = min(end, datetime.date(date.year, 12, 31))
+            first, last = self.day_of_year(date), self.day_of_year(year_end)
+            if not self.is_leap(date.year) and (year_end.month, year_end.day) == (2, 28):
+                last += 1                   #29 FEB events are celebrated on 28 FEB
+            for i in range(bisect_left(self.days, first), bisect_right(self.days, last)):
+                ID, event = self.events[i]
+                if (event.month, event.day) == (2, 29) and not self.is_leap(date.year):
+                    occurrence = datetime.date(date.year, 2, 28)
+                else:
+                    occurrence = event.replace(year = date.year)
+                if ID not in seen and occurrence > event:
+                    seen.add(ID)
+                    yield ID, occurrence
+            date = year_end + datetime.timedelta(days = 1)
+
+
+Relationship = namedtuple("Relationship", ["description", "ancestor", "up", "down"])
+
+class AncestryIndex:
+    """Parents, generation depth and blood line (connected component) of every individual, used to find the closest
+       common ancestor of two individuals and name their relationship. Any number of parents is supported, the parents
+       are the spouses of every family listing the individual as a CHIL, or of their FAMC family if no family lists them.
+       Only the parents, the depth and the blood line (connected component) of each individual are stored, so the index
+       grows with the number of people and not with their ancestors. A query searches up from both individuals one
+       generation at a time and stops as soon as no closer common ancestor can be found, people of different blood
+       lines are told apart without a search"""
+    def __init__(self, individuals, family):
+        self.individuals = individuals
+        self.family = family
+        self.parents = defaultdict(set)     #Key = IndiID Value = set of parent IDs
+        for fam in family.values():
+            for child in fam.chil:
+                self.parents[child] |= {fam.husb, fam.wife}
+        for ID, indi in individuals.items():
+            if ID not in self.parents and indi.famc in family:
+                self.parents[ID] |= {family[indi.famc].husb, family[indi.famc].wife}
+        for ID in list(self.parents):
+            self.parents[ID] = {parent for parent in self.parents[ID] if parent in individuals and parent != ID}
+        self.depth = dict()                 #Key = IndiID Value = generations to their furthest known ancestor
+        self.line = dict()                  #Key = IndiID Value = ID of the first ancestor found in their blood line
+        self.known = dict()                 #Key = IndiID Value = every ancestor of someone queried many times, see relationships
+        for ID in individuals:
+            self.add_depth(ID)
+        for ID in individuals:
+            self.line[ID] = self.find_line(ID)
+
+    def add_depth(self, ID):
+        """Fills in the depth of the individual after those of their parents, iteratively so deep trees do not hit the
+           recursion limit. A parent that is also a descendant (a cycle in bad data) is removed from the parents"""
+        stack, visiting = [ID], set()
+        while stack:
+            current = stack[-1]
+            if current in self.depth:
+                stack.pop()
+                continue
+            waiting = [parent for parent in self.parents.get(current, ()) if parent not in self.depth and parent not in visiting]
+            if current not in visiting and waiting:
+                visiting.add(current)
+                stack += waiting
+                continue
+            stack.pop()
+            visiting.discard(current)
+            if current in self.parents:
+                self.parents[current] = {parent for parent in self.parents[current] if parent in self.depth}
+            self.depth[current] = max([self.depth[parent] + 1 for parent in self.parents.get(current, ())] or [0])
+
+    def find_line(self, ID):
+        """Union-find over the parent links: returns the representative of the individual's blood line"""
+        root = self.line.setdefault(ID, ID)
+        while self.line[root] != root:
+            self.line[root] = self.line[self.line[root]]    #path halving
+            root = self.line[root]
+        for parent in self.parents.get(ID, ()):
+            other = self.line.setdefault(parent, parent)
+            while self.line[other] != other:
+                self.line[other] = self.line[self.line[other]]
+                other = self.line[other]
+            if other != root:
+                self.line[other] = root
+        return root
+
+    def same_line(self, a, b):
+        """Returns True if a and b can be blood relatives"""
+        return self.find_line(a) == self.find_line(b)
+
+    def generations(self, ID, limit = None):
+        """Returns Key = ancestor ID (themselves included) Value = generations up, the shortest way, up to limit generations"""
+        found, level, up = {ID: 0}, {ID}, 0
+        while level and (limit == None or up < limit):
+            up += 1
+            level = self.next_generation(level, found)
+            found.update(dict.fromkeys(level, up))
+        return found
+
+    def next_generation(self, level, found):
+        """Returns the parents of the people in level that are not in found yet"""
+        return set().union(*[self.parents.get(person, ()) for person in level]).difference(found)
+
+    def common_ancestor(self, a, b, limit = None):
+        """Returns (ancestor ID, generations up from a, generations up from b) for the closest common ancestor of a and b,
+           None if they are not blood relatives. Among ancestors as close, the one with the most even generations is taken,
+           then the one fewest generations from a, then the smallest ID. With limit, only ancestors with up + down of
+           at most limit are looked for"""
+        return self.search(a, b, limit)[0]
+
+    def search(self, a, b, limit = None):
+        """Returns the common_ancestor of a and b with the generations up from a and from b to everyone the search went
+           through. Both sides go up one generation at a time, the side with the fewest people at its last generation first,
+           until no common ancestor closer than the best one found can be left"""
+        if not self.same_line(a, b):
+            return None, None, None
+        found = [self.known.get(a, {a: 0}), self.known.get(b, {b: 0})]
+        levels = [set() if a in self.known else {a}, set() if b in self.known else {b}]
+        ups, best = [0, 0], None
+        for start in (a, b):                #one of them is an ancestor of the other, or themselves
+            if start in found[0] and start in found[1]:
+                total = found[0][start] + found[1][start]
+                best = total if best == None else min(best, total)
+        while True:
+            open_sides = [side for side in (0, 1) if levels[side]]
+            if not open_sides:
+                break
+            bound = min(ups[side] + 1 for side in open_sides)     #an ancestor not found yet is further up than its side went
+            if (best != None and best < bound) or (limit != None and bound > limit):
+                break                       #every ancestor as close as best was found on both sides
+            side = min(open_sides, key = lambda side: (len(levels[side]), side))
+            ups[side] += 1
+            level = self.next_generation(levels[side], found[side])
+            found[side].update(dict.fromkeys(level, ups[side]))
+            other = found[1 - side]
+            meeting = other.keys() & level
+            if meeting:
+                total = ups[side] + min(other[ancestor] for ancestor in meeting)
+                best = total if best == None else min(best, total)
+            levels[side] = level
+        up_a, up_b = found
+        if best == None or (limit != None and best > limit):
+            return None, up_a, up_b
+        if len(up_b) < len(up_a):
+            up_a, up_b = up_b, up_a
+        closest = [ancestor for ancestor in up_a if ancestor in up_b and up_a[ancestor] + up_b[ancestor] == best]
+        up_a, up_b = found
+        return min(((ancestor, up_a[ancestor], up_b[ancestor]) for ancestor in closest),
+                   key = lambda common: (abs(common[1] - common[2]), common[1], common[0])), up_a, up_b
+
+    def is_half(self, a, b, up, down, ancestors_a = None, ancestors_b = None):
+        """Two lines are half relatives when no couple is common to both at the closest level, e.g. siblings with one shared parent.
+           ancestors_a and ancestors_b are generations up from a and b found by a search, they are found again if not given"""
+        if ancestors_a == None:
+            ancestors_a, ancestors_b = self.generations(a, up), self.generations(b, down)
+        closest = {ancestor for ancestor, generations in ancestors_a.items() if generations == up and ancestors_b.get(ancestor) == down}
+        for ancestor in closest:
+            for fam in self.individuals[ancestor].fams:
+                if fam in self.family and {self.family[fam].husb, self.family[fam].wife} - {None} <= closest:
+                    return False
+        return True
+
+    @staticmethod
+    def greats(count):
+        """Prefix for the generations past grand: '', 'great-', '2nd great-', ..."""
+        if count <= 0:
+            return ""
+        return "great-" if count == 1 else "{} great-".format(AncestryIndex.ordinal(count))
+
+    @staticmethod
+    def ordinal(number):
+        suffix = "th" if 10 <= number % 100 <= 20 else {1: "st", 2: "nd", 3: "rd"}.get(number % 10, "th")
+        return "{}{}".format(number, suffix)
+
+    def describe(self, up, down, half):
+        """Names what someone down generations below the common ancestor is to someone up generations below it"""
+        if up == 0 and down == 0:
+            return "self"
+        if up == 0:
+            return ["child", "grandchild"][down - 1] if down <= 2 else self.greats(down - 2) + "grandchild"
+        if down == 0:
+            return ["parent", "grandparent"][up - 1] if up <= 2 else self.greats(up - 2) + "grandparent"
+        prefix = "half-" if half else ""
+        if up == 1 and down == 1:
+            return prefix + "sibling"
+        if up == 1:
+            return prefix + ("niece/nephew" if down == 2 else self.greats(down - 3) + "grandniece/nephew")
+        if down == 1:
+            return prefix + self.greats(up - 2) + "aunt/uncle"
+        removed = abs(up - down)
+        times = {0: "", 1: " once removed", 2: " twice removed"}.get(removed, " {} times removed".format(removed))
+        return "{}{} cousin{}".format(prefix, self.ordinal(min(up, down) - 1), times)
+
+    def blood_relationship(self, a, b):
+        """Returns the Relationship of b to a through their closest common ancestor, None if they are not blood relatives"""
+        common, ancestors_a, ancestors_b = self.search(a, b)
+        if common == None:
+            return None
+        ancestor, up, down = common
+        half = up > 0 and down > 0 and self.is_half(a, b, up, down, ancestors_a, ancestors_b)
+        return Relationship(self.describe(up, down, half), ancestor, up, down)
+
+    def spouses(self, ID):
+        """Returns the set of everyone the individual has been married to"""
+        spouses = set()
+        for fam in self.individuals[ID].fams:
+            if fam in self.family:
+                spouses |= {self.family[fam].husb, self.family[fam].wife}
+        return spouses - {None, ID}
+
+    def relationship(self, a, b):
+        """Returns the Relationship describing what b is to a: a blood relationship (nth cousin m times removed,
+           half-siblings, ...), a spouse, or an in-law through one marriage. The description is "unrelated" otherwise"""
+        blood = self.blood_relationship(a, b)
+        if blood != None:
+            return blood
+        if b in self.spouses(a):
+            return Relationship("spouse", None, None, None)
+        #relatives of a spouse, e.g. a parent-in-law
+        in_law = {"parent": "parent-in-law", "child": "step-child", "sibling": "sibling-in-law", "half-sibling": "sibling-in-law"}
+        for spouse in sorted(self.spouses(a)):
+            blood = self.blood_relationship(spouse, b)
+            if blood != None:
+                return Relationship(in_law.get(blood.description, blood.description + "-in-law"), blood.ancestor, None, None)
+        #spouses of a relative, e.g. a child-in-law
+        in_law = {"parent": "step-parent", "child": "child-in-law", "sibling": "sibling-in-law", "half-sibling": "sibling-in-law"}
+        for spouse in sorted(self.spouses(b)):
+            blood = self.blood_relationship(a, spouse)
+            if blood != None:
+                return Relationship(in_law.get(blood.description, blood.description + "-in-law"), blood.ancestor, None, None)
+        return Relationship("unrelated", None, None, None)
+
+    def relationships(self, pairs):
+        """Batch version of relationship: returns the Relationship for every (a, b) pair in the iterable. The pairs are
+           answered grouped by a, when a is asked about more than once their ancestors are found once for the group
+           and each b only searches up until it meets them"""
+        pairs = list(pairs)
+        answers, counts = dict(), Counter(a for a, b in set(pairs))
+        for a, b in sorted(set(pairs)):
+            if a not in self.known and counts[a] > 1:
+                self.known = {a: self.generations(a)}
+            answers[(a, b)] = self.relationship(a, b)
+        self.known = dict()
+        return [answers[pair] for pair in pairs]
+
+
+class CheckedRecords(Mapping):
+    """The records of a partial run: every record read can be looked up, but only the subjects are iterated over,
+       so the user stories only report on the subjects while their relatives are still there to compare with"""
+    def __init__(self, records, subjects):
+        self.records = records
+        self.subjects = [ID for ID in records if ID in subjects]    #in file order like a full run
+
+    def __getitem__(self, ID):
+        return self.records[ID]
+
+    def __iter__(self):
+        return iter(self.subjects)
+
+    def __len__(self):
+        return len(self.subjects)
+
+
+Rule = namedtuple("Rule", ["stories", "category", "method", "needs", "cost"])
+
+#days and years are the exact age, calendar_years is the difference of the years like Individual.age
+Age = namedtuple("Age", ["days", "years", "calendar_years"])
+
+def exact_age(birt, end):
+    """Returns the Age of someone born on birt on the end date"""
+    years = end.year - birt.year
+    return Age((end - birt).days, years - ((end.month, end.day) < (birt.month, birt.day)), years)
+
+def age_index(individuals, as_of):
+    """Returns Key = IndiID Value = Age, the age at death, or on as_of for the living, in one pass over the individuals.
+       Individuals without a birth date are left out, people born after as_of get negative ages"""
+    ages = dict()
+    for ID, indi in individuals.items():
+        if indi.birt != None:
+            ages[ID] = exact_age(indi.birt, indi.deat if indi.deat != None else as_of)
+    return ages
+
+
+class BudgetExhausted(Exception):
+    """Raised by CheckForErrors.add_error in a budgeted run to stop the current rule, or every rule if stop_all is True"""
+    def __init__(self, stop_all):
+        super(BudgetExhausted, self).__init__("The error budget is used up")
+        self.stop_all = stop_all
+
 
 class CheckForErrors:
     """This class runs through all the user stories and looks for possible errors in the GEDCOM data"""
-    def __init__(self, ind_dict, fam_dict, errors, print_errors):
+    #Every user story check: the story IDs it covers, whether it reports errors or only lists information,
+    #the method that runs it, the derived indexes that have to be built before it can run and its relative cost:
+    #1 = one pass over the records, 2 = a pass with lookups or pairs of children, 3 = quadratic or needs the ancestry index
+    RULES = [
+        Rule(("US01",), "error", "dates_before_curr", (), 1),
+        Rule(("US02",), "error", "indi_birth_before_marriage", (), 1),
+        Rule(("US03",), "error", "birth_before_death", (), 1),
+        Rule(("US04",), "error", "marr_before_div", (), 1),
+        Rule(("US05", "US06"), "error", "marr_div_before_death", (), 1),
+        Rule(("US07",), "error", "normal_age", ("ages",), 1),
+        Rule(("US08",), "error", "birth_before_marriage", (), 1),
+        Rule(("US09",), "error", "brith_before_death_of_parents", (), 1),
+        Rule(("US10",), "error", "spouses_too_young", (), 1),
+        Rule(("US11",), "error", "no_bigamy", (), 2),
+        Rule(("US12",), "error", "parents_too_old", ("ages",), 1),
+        Rule(("US13",), "error", "sibling_spacing", ("sorted_children",), 2),
+        Rule(("US14",), "error", "too_many_births", ("sorted_children",), 1),
+        Rule(("US15",), "error", "too_many_siblings", (), 1),
+        Rule(("US17",), "error", "no_marriage_to_descendants", (), 3),
+        Rule(("US18",), "error", "no_marriage_to_siblings", (), 2),
+        Rule(("US19",), "error", "no_marriage_to_cousin", ("ancestry",), 3),
+        Rule(("US20",), "error", "creepy_aunts_and_uncles", ("ancestry",), 3),
+        Rule(("US21",), "error", "correct_gender_role", (), 1),
+        Rule(("US23",), "error", "unique_names_and_bdays", (), 3),
+        Rule(("US24",), "error", "unique_spouses_in_family", (), 3),
+        Rule(("US25",), "error", "unique_children_in_family", (), 1),
+        Rule(("US27",), "listing", "list_ages", ("ages",), 1),
+        Rule(("US28",), "listing", "order_siblings_oldest_to_youngest", ("sorted_children",), 2),
+        Rule(("US29",), "listing", "list_deceased", (), 1),
+        Rule(("US30",), "listing", "list_living_married", (), 2),
+        Rule(("US31",), "listing", "list_living_single", ("ages",), 2),
+        Rule(("US32",), "listing", "list_multiple_births", ("sorted_children",), 2),
+        Rule(("US39",), "listing", "list_anniversaries", ("anniversaries",), 1),
+    ]
+    PARSE_STORIES = {"US22", "US26", "US27", "US42"}    #stories reported while parsing, they can be limited but not run
+    #Key = name of a derived index, Value = method that builds it and stores it in the attribute of the same name
+    INDEXES = {"sorted_children": "build_sorted_children", "ancestry": "build_ancestry", "anniversaries": "build_anniversaries", "ages": "build_ages"}
+
+    def __init__(self, ind_dict, fam_dict, errors, print_errors, stories = None, as_of = None, max_errors = None, limits = None, fail_fast = False,
+                 ages = None, subjects = None):
         """This instantiates variables in this class to the dictionaries of families and individuals from
-        the AnalyzeGEDCOM class, it also calls all US methods while providing an option to print all errors"""
-        self.individuals = ind_dict
-        self.family = fam_dict
+        the AnalyzeGEDCOM class, it also calls the US methods while providing an option to print all errors.
+        If a set of story IDs is given only those stories (and the indexes they need) are run.
+        as_of is the date the checks treat as the current date, today if not given.
+        max_errors limits the number of messages (parse errors included) and limits the messages of each story,
+        e.g. {"US01": 3}, the first parse errors that fit are kept. A story in limits that is not known raises ValueError.
+        fail_fast only runs the error stories and stops at the first error.
+        A budgeted run schedules the cheapest rules first and sets budget_exhausted if it stopped early.
+        ages is the age_index already computed for as_of, it is built here when it is not given.
+        subjects limits the checks to those IDs, the other records are only looked up as their relatives"""
+        self.read_individuals = ind_dict    #every record, the indexes are built over them
+        self.read_family = fam_dict
+        self.individuals = ind_dict if subjects == None else CheckedRecords(ind_dict, subjects)
+        self.family = fam_dict if subjects == None else CheckedRecords(fam_dict, subjects)
         self.all_errors = errors
-        self.dates_before_curr()                #US01
-        self.indi_birth_before_marriage()       #US02
-        self.birth_before_death()               #US03
-        self.marr_before_div()                  #US04
-        self.marr_div_before_death()            #US05 & US06
-        self.normal_age()                       #US07
-        self.birth_before_marriage()            #US08
-        self.brith_before_death_of_parents()    #US09
-        self.spouses_too_young()                #US10
-        self.no_bigamy()                        #US11
-        self.parents_too_old()                  #US12
-        self.sibling_spacing()                  #US13
-        self.too_many_births()                  #US14
-        self.too_many_siblings()                #US15
-        self.no_marriage_to_descendants()       #US17
-        self.no_marriage_to_siblings()          #US18
-        self.no_marriage_to_cousin()            #US19
-        self.creepy_aunts_and_uncles()          #US20
-        self.correct_gender_role()              #US21
-        self.unique_names_and_bdays()           #US23
-        self.unique_spouses_in_family()         #US24
-        self.unique_children_in_family()        #US25
-        self.list_ages()                        #US27
-        self.order_siblings_oldest_to_youngest()#US28
-        self.list_deceased()                    #US29
-        self.list_living_married()              #US30
-        self.list_living_single()               #US31
-        self.list_multiple_births()             #US32
-        self.list_anniversaries()               #US39
+        self.as_of = as_of if as_of != None else datetime.date.today()
+        if ages != None:
+            self.ages = ages
+        rules = self.select_rules(stories)
+        if fail_fast:
+            rules = [rule for rule in rules if rule.category == "error"]
+            max_errors = 1
+        self.max_errors = max_errors
+        self.limits = dict(limits) if limits != None else dict()
+        unknown = set(self.limits) - self.story_ids() - self.PARSE_STORIES
+        if unknown:
+            raise ValueError("Unknown user stories in limits: {}".format(", ".join(sorted(unknown))))
+        self.budgeted = max_errors != None or len(self.limits) > 0
+        self.counts = defaultdict(int)          #Key = story ID Value = number of its messages, only kept in budgeted runs
+        self.budget_exhausted = False
+        if self.budgeted:
+            rules.sort(key = lambda rule: rule.cost)
+            self.limit_parse_errors()
+            rules = [rule for rule in rules if not all(self.used_up(story) for story in rule.stories)]   #e.g. a limit of 0
+        self.run_rules(rules)
 
         if print_errors == True:
             self.print_errors()
 
+    @classmethod
+    def select_rules(cls, stories = None):
+        """Returns the rules covering the given story IDs in their normal running order, all rules if stories is None"""
+        if stories is None:
+            return list(cls.RULES)
+        stories = set(stories)
+        unknown = stories - cls.story_ids()
+        if unknown:
+            raise ValueError("Unknown user stories: {}".format(", ".join(sorted(unknown))))
+        return [rule for rule in cls.RULES if stories.intersection(rule.stories)]
+
+    @classmethod
+    def story_ids(cls, category = None):
+        """Returns the set of story IDs that can be run, optionally only those of one category ("error" or "listing")"""
+        return {story for rule in cls.RULES if category in (None, rule.category) for story in rule.stories}
+
+    def limit_parse_errors(self):
+        """Keeps the first parse errors that fit in the global and per story budgets, in the order they were found"""
+        parse_errors, kept = list(self.all_errors), []
+        for error in parse_errors:
+            if self.max_errors != None and len(kept) >= self.max_errors:
+                break
+            if not any(self.used_up(story) for story in error.split(":", 1)[0].split(" & ")):
+                kept += [error]
+                self.count_error(error)
+        self.all_errors[:] = kept
+        self.budget_exhausted = len(kept) < len(parse_errors)
+
+    def run_rules(self, rules):
+        """Runs the rules in order, building the indexes each one needs the first time they are needed"""
+        if self.max_errors != None and len(self.all_errors) >= self.max_errors:
+            self.budget_exhausted = True        #the parse errors already used up the budget
+            return
+        for rule in rules:
+            for index in rule.needs:
+                if not hasattr(self, index):
+                    getattr(self, self.INDEXES[index])()
+            try:
+                getattr(self, rule.method)()
+            except BudgetExhausted as exhausted:
+                self.budget_exhausted = True
+                if exhausted.stop_all:
+                    return
+
+    def build_sorted_children(self):
+        """Index: Key = FamID Value = list of the family's children IDs sorted, so the order is the same every run"""
+        self.sorted_children = {ID: sorted(fam.chil) for ID, fam in self.family.items()}
+
+    def build_ancestry(self):
+        """Index: the AncestryIndex used to find how two individuals are related"""
+        self.ancestry = AncestryIndex(self.read_individuals, self.read_family)
+
+    def build_anniversaries(self):
+        """Index: marriage dates sorted by day of the year"""
+        self.anniversaries = DayOfYearIndex((ID, fam.marr) for ID, fam in self.family.items() if fam.marr != None)
+
+    def build_ages(self):
+        """Index: Key = IndiID Value = Age, exact ages in days and years on the as_of date"""
+        self.ages = age_index(self.read_individuals, self.as_of)
+
     def date_difference(self, d1, d2):
         """Returns true if the difference between the two dates is positive: [d1 - d2]"""
         return (d1 - d2).days
 
+    def name(self, ID):
+        """Returns the name of a spouse, "unknown" for the missing parent of a single parent family (ID None)"""
+        return self.individuals[ID].name if ID != None else "unknown"
+
+    def born_after(self, ID, date):
+        """Returns True if the individual was born after the date, False if the individual, the birth or the date is unknown"""
+        birth = self.individuals[ID].birt if ID != None else None
+        return birth != None and date != None and birth > date
+
     def dates_before_curr(self):
         """US01: Tests to ensure any dates do not occur after current date"""
         for fam in self.family.values():
             marrDate=fam.marr
             divDate=fam.div
-            if(marrDate>datetime.datetime.now().date()):
-                self.all_errors+=["US01: The marriage of {} and {} cannot occur after the current date.".format(self.individuals[fam.husb].name, self.individuals[fam.wife].name)]
-            if(divDate != None and divDate>datetime.datetime.now().date()):
-                self.all_errors+=["US01: The divorce of {} and {} cannot occur after the current date.".format(self.individuals[fam.husb].name, self.individuals[fam.wife].name)]
+            if(marrDate != None and marrDate>self.as_of):
+                self.add_error("US01: The marriage of {} and {} cannot occur after the current date.".format(self.name(fam.husb), self.name(fam.wife)))
+            if(divDate != None and divDate>self.as_of):
+                self.add_error("US01: The divorce of {} and {} cannot occur after the current date.".format(self.name(fam.husb), self.name(fam.wife)))
 
         for indi in self.individuals.values():
             birthday=indi.birt
             deathDay=indi.deat
-            if(birthday>datetime.datetime.now().date()):
-                self.all_errors+=["US01: The birth of {} cannot occur after the current date.".format(indi.name)]
-            if(deathDay != None and deathDay>datetime.datetime.now().date()):
-                self.all_errors+=["US01: The death of {} cannot occur after the current date.".format(indi.name)]
+            if(birthday != None and birthday>self.as_of):
+                self.add_error("US01: The birth of {} cannot occur after the current date.".format(indi.name))
+            if(deathDay != None and deathDay>self.as_of):
+                self.add_error("US01: The death of {} cannot occur after the current date.".format(indi.name))
 
     def indi_birth_before_marriage(self):
         """US02: Tests to ensure a married individual was not born after their marriage"""
         for fam in self.family.values():
-            birth_husb = self.individuals[fam.husb].birt
-            birth_wife = self.individuals[fam.wife].birt
-            marr_date = fam.marr
+            husb_late = self.born_after(fam.husb, fam.marr)
+            wife_late = self.born_after(fam.wife, fam.marr)
 
-            if(birth_husb>marr_date and birth_wife>marr_date):
-                self.all_errors += ["US02: {}'s birth can not occur after their date of marriage".format(self.individuals[fam.husb].name)
-                             + " and " + "{}'s birth can not occur after their date of marriage".format(self.individuals[fam.wife].name)]
+            if(husb_late and wife_late):
+                self.add_error("US02: {}'s birth can not occur after their date of marriage".format(self.individuals[fam.husb].name)
+                             + " and " + "{}'s birth can not occur after their date of marriage".format(self.individuals[fam.wife].name))
 
-            elif(birth_husb>marr_date):
-                self.all_errors += ["US02: {}'s birth can not occur after their date of marriage".format(self.individuals[fam.husb].name)]
-            elif(birth_wife>marr_date):
-                self.all_errors += ["US02: {}'s birth can not occur after their date of marriage".format(self.individuals[fam.wife].name)]
+            elif(husb_late):
+                self.add_error("US02: {}'s birth can not occur after their date of marriage".format(self.individuals[fam.husb].name))
+            elif(wife_late):
+                self.add_error("US02: {}'s birth can not occur after their date of marriage".format(self.individuals[fam.wife].name))
 
     def birth_before_death(self):
         """US03: Tests to ensure that birth occurs before the death of an individual"""
         for person in self.individuals.values():
-            if person.deat != None and self.date_difference(person.deat, person.birt) < 0:
-                self.all_errors += ["US03: {}'s death can not occur before their date of birth".format(person.name)]
+            if person.deat != None and person.birt != None and self.date_difference(person.deat, person.birt) < 0:
+                self.add_error("US03: {}'s death can not occur before their date of birth".format(person.name))
 
     def marr_before_div(self):
         """US04: Tests to ensure that marriage dates come before divorce dates"""
         for fam in self.family.values():
-            if fam.div != None and self.date_difference(fam.div, fam.marr) < 0:
-                self.all_errors += ["US04: {} and {}'s divorce can not occur before their date of marriage".format(self.individuals[fam.husb].name, self.individuals[fam.wife].name)]
+            if fam.div != None and fam.marr != None and self.date_difference(fam.div, fam.marr) < 0:
+                self.add_error("US04: {} and {}'s divorce can not occur before their date of marriage".format(self.name(fam.husb), self.name(fam.wife)))
 
     def marr_div_before_death(self):
         """US05 & US06: This tests to make sure that no one was married or divorced after they died"""
         for fam in self.family.values():
-            deat_husb = self.individuals[fam.husb].deat
-            deat_wife = self.individuals[fam.wife].deat
+            deat_husb = self.individuals[fam.husb].deat if fam.husb != None else None
+            deat_wife = self.individuals[fam.wife].deat if fam.wife != None else None
             marr_date, div_date = fam.marr, fam.div
             check_husb_m, check_husb_d, check_wife_d, check_wife_m = 1, 1, 1, 1 #Let the if else statements assign these their proper values
+            if marr_date == None:
+                continue       #Without a marriage date there is nothing to compare
             if deat_husb == None and deat_wife == None:
-                break          #We do not need to analyze further if both are alive
+                continue       #We do not need to analyze further if both are alive
             elif div_date == None:      #We will now consider the case the two were still married when one/both spouse died
                 if deat_husb != None:
                     check_husb_m = (deat_husb - marr_date).days
@@ -294,48 +922,47 @@ class CheckForErrors:
                     check_wife_m = (deat_wife - marr_date).days
                     check_wife_d = (deat_wife - div_date).days
             if check_husb_m < 0 or check_wife_m < 0 or check_husb_d < 0 or check_wife_d < 0:
-                self.all_errors += ["US05 & US06: Either {} or {} were married or divorced after they died".format(self.individuals[fam.husb].name, self.individuals[fam.wife].name)]
+                self.add_error("US05 & US06: Either {} or {} were married or divorced after they died".format(self.name(fam.husb), self.name(fam.wife)))
 
     def normal_age(self):
         """US07: Checks to make sure that the person's age is less than 150 years old"""
-        for individual in self.individuals.values():
-            if individual.age == None:
-                pass
-            if individual.age >= 150:
-                self.all_errors += ["US07: {}'s age calculated ({}) is over 150 years old".format(individual.name, individual.age)]
+        for ID in self.individuals:
+            age = self.ages.get(ID)
+            if age != None and age.calendar_years >= 150:
+                self.add_error("US07: {}'s age calculated ({}) is over 150 years old".format(self.individuals[ID].name, age.calendar_years))
 
     def birth_before_marriage(self):
         """US08: This checks to see if someone was born before the parents were married
             or 9 months after divorce"""
         for individual in self.individuals.values():
             birth_date = individual.birt #each individual birthday
-            if individual.famc != None:
+            if individual.famc != None and birth_date != None:
                 marriage_date = self.family[individual.famc].marr #each family (that child is in) marraige date
                 divorce_date = self.family[individual.famc].div #divorce date of parents
                 if divorce_date != None:
                     diff_divorce_and_birth_date = (birth_date.year - divorce_date.year) * 12 + birth_date.month - divorce_date.month
-                if (birth_date - marriage_date).days <= 0:
-                    self.all_errors += ["US08: {} was born before their parents were married".format(individual.name)]
+                if marriage_date != None and (birth_date - marriage_date).days <= 0:
+                    self.add_error("US08: {} was born before their parents were married".format(individual.name))
                 elif divorce_date != None and diff_divorce_and_birth_date >= 9:
-                    self.all_errors += ["US08: {} was born {} months after their parents were divorced".format(individual.name, diff_divorce_and_birth_date)]
+                    self.add_error("US08: {} was born {} months after their parents were divorced".format(individual.name, diff_divorce_and_birth_date))
 
     def brith_before_death_of_parents(self):
         "US09: Checks to see if someone was born before their parent died"
         for individual in self.individuals.values():
             birth_date = individual.birt #each individual birthday
-            if individual.famc != None:
+            if individual.famc != None and birth_date != None:
                 fatherID = self.family[individual.famc].husb #father ID
                 motherID = self.family[individual.famc].wife #mother ID
-                father_death = self.individuals[fatherID].deat
-                mother_death = self.individuals[motherID].deat
+                father_death = self.individuals[fatherID].deat if fatherID != None else None
+                mother_death = self.individuals[motherID].deat if motherID != None else None
                 if father_death != None:
                     father_difference = (birth_date.year - father_death.year) * 12 + birth_date.month - father_death.month
                     if father_difference >= 9:
-                        self.all_errors += ["US09: {} was born {} months after father died".format(individual.name, father_difference)]
+                        self.add_error("US09: {} was born {} months after father died".format(individual.name, father_difference))
                 if mother_death != None:
                     mother_difference = (birth_date - mother_death).days
                     if mother_difference >= 0:
-                        self.all_errors += ["US09: {} was born after mother died".format(individual.name)]
+                        self.add_error("US09: {} was born after mother died".format(individual.name))
 
     def spouses_too_young(self):
         """US10: Checks to make sure that each spouse of a family is older than 14 years old when
@@ -344,18 +971,22 @@ class CheckForErrors:
             if len(individual.fams) > 0:
                 for family in individual.fams:
                     marriage_date = self.family[family].marr
+                    if marriage_date == None or individual.birt == None:
+                        continue
                     marriage_difference = marriage_date.year - individual.birt.year
                     if marriage_difference <= 14:
-                        self.all_errors += ["US10: {} was only {} years old when they got married".format(individual.name, marriage_difference)]
+                        self.add_error("US10: {} was only {} years old when they got married".format(individual.name, marriage_difference))
 
     def no_bigamy(self):
         """US11: Tests to ensure marriage does not occur during marriage with someone else"""
         for fam in self.family.values():
-            if len(self.individuals[fam.husb].fams) <= 1 and len(self.individuals[fam.husb].fams):
+            husb_fams = self.individuals[fam.husb].fams if fam.husb != None else set()   #a missing spouse has no families
+            wife_fams = self.individuals[fam.wife].fams if fam.wife != None else set()
+            if len(husb_fams) <= 1 and len(husb_fams):
                 continue           #If they are only a spouse in one family no need to continue, same for not being a spouse
-            if len(self.individuals[fam.husb].fams) > 1:      #checks if husb is a bigamist
+            if len(husb_fams) > 1:      #checks if husb is a bigamist
                 count = 0
-                for spouse in sorted(self.individuals[fam.husb].fams):   #want to ensure the set is ordered
+                for spouse in sorted(husb_fams):   #want to ensure the set is ordered
                     curr_marr_date = self.family[spouse].marr
                     curr_div_date = self.family[spouse].div
                     if count == 0:
@@ -365,13 +996,13 @@ class CheckForErrors:
                         continue
                     if prev_div_date == None:
                         self.add_errors_if_new("US11: {} is practing bigamy".format(self.individuals[fam.husb].name))
-                    elif (curr_marr_date - prev_marr_date).days > 0 and (curr_marr_date - prev_div_date).days < 0:
+                    elif None not in (curr_marr_date, prev_marr_date) and (curr_marr_date - prev_marr_date).days > 0 and (curr_marr_date - prev_div_date).days < 0:
                         self.add_errors_if_new("US11: {} is practing bigamy".format(self.individuals[fam.husb].name))
                     prev_marr_date = self.family[spouse].marr
                     prev_div_date = self.family[spouse].div
-            if len(self.individuals[fam.wife].fams) > 1:       #checks if wife is a bigamist
+            if len(wife_fams) > 1:       #checks if wife is a bigamist
                 count = 0
-                for spouse in sorted(self.individuals[fam.wife].fams):
+                for spouse in sorted(wife_fams):
                     curr_marr_date = self.family[spouse].marr
                     curr_div_date = self.family[spouse].div
                     if count == 0:
@@ -381,7 +1012,7 @@ class CheckForErrors:
                         continue
                     if prev_div_date == None:
                         self.add_errors_if_new("US11: {} is practing bigamy".format(self.individuals[fam.wife].name))
-                    elif (curr_marr_date - prev_marr_date).days > 0 and (curr_marr_date - prev_div_date).days < 0:
+                    elif None not in (curr_marr_date, prev_marr_date) and (curr_marr_date - prev_marr_date).days > 0 and (curr_marr_date - prev_div_date).days < 0:
                         self.add_errors_if_new("US11: {} is practing bigamy".format(self.individuals[fam.wife].name))
                     prev_marr_date = self.family[spouse].marr
                     prev_div_date = self.family[spouse].div
@@ -390,73 +1021,81 @@ class CheckForErrors:
         """US12: This method tests to ensure that parents in a family are not too old.
         Mother should be less than 60 years older than children.
         Father should be less than 80 years older than children."""
-        for indi in self.individuals.values():
-            if indi.famc == None:                   #No need to continue if they are not a child
+        for ID, indi in self.individuals.items():
+            if indi.famc == None or ID not in self.ages:    #No need to continue if they are not a child or have no age
                 continue
-            if self.individuals[self.family[indi.famc].husb].age > (indi.age + 80): #check the father
-                self.all_errors += ["US12: {} is over 80 years older than his child {}".format(self.individuals[self.family[indi.famc].husb].name, indi.name)]
-            if self.individuals[self.family[indi.famc].wife].age > (indi.age + 60): #check the mother
-                self.all_errors += ["US12: {} is over 60 years older than his child {}".format(self.individuals[self.family[indi.famc].wife].name, indi.name)]
+            age = self.ages[ID].calendar_years
+            father, mother = self.family[indi.famc].husb, self.family[indi.famc].wife
+            if father in self.ages and self.ages[father].calendar_years > (age + 80): #check the father
+                self.add_error("US12: {} is over 80 years older than his child {}".format(self.individuals[self.family[indi.famc].husb].name, indi.name))
+            if mother in self.ages and self.ages[mother].calendar_years > (age + 60): #check the mother
+                self.add_error("US12: {} is over 60 years older than his child {}".format(self.individuals[self.family[indi.famc].wife].name, indi.name))
 
     def sibling_spacing(self):
         """US13: Makes sure that birth dates of siblings should be more than 8 months apart
         or less than 2 days apart (twins may be born one day apart, e.g. 11:59 PM and 12:02 AM the following calendar day)"""
-        for fam in self.family.values():
-            childIDLstCopy = deepcopy(list(fam.chil))
-            childIDLstCopy.sort() #needs to be sorted since every time the program runs, the order of the children set changes
+        for ID, fam in self.family.items():
+            childIDLstCopy = self.sorted_children[ID] #sorted since every time the program runs, the order of the children set changes
 
             for i in range(len(childIDLstCopy)):
                 for j in range(i + 1, len(childIDLstCopy)):
                     child1 = self.individuals[childIDLstCopy[i]]
                     child2 = self.individuals[childIDLstCopy[j]]
+                    if child1.birt == None or child2.birt == None:
+                        continue
                     daysApart = abs(child1.birt - child2.birt).days
                     monthsApart = abs((child1.birt.year - child2.birt.year) * 12 + child1.birt.month - child2.birt.month)
                     if daysApart > 2 and monthsApart < 8 :
-                        self.all_errors += ["US13: Siblings {} and {}'s births are ".format(child1.name, child2.name) + str(daysApart) + " days apart"]
+                        self.add_error("US13: Siblings {} and {}'s births are ".format(child1.name, child2.name) + str(daysApart) + " days apart")
 
 
     def too_many_births(self):
         """US14: Makes sure that no more than five siblings should be born at the same time"""
-        for fam in self.family.values():
-            childIDLstCopy = deepcopy(list(fam.chil))
-            childIDLstCopy.sort() #needs to be sorted since every time the program runs, the order of the children set changes
+        for ID, fam in self.family.items():
+            childIDLstCopy = self.sorted_children[ID] #sorted since every time the program runs, the order of the children set changes
 
             birthDayDict = {}
             for i in range(len(childIDLstCopy)):
                 child = self.individuals[childIDLstCopy[i]]
+                if child.birt == None:      #children without a birth date were not born at the same time as anyone
+                    continue
                 if child.birt not in birthDayDict:
                     birthDayDict[child.birt] = 1
                 else:
                     birthDayDict[child.birt] = birthDayDict[child.birt] + 1
             for key in birthDayDict:
                 if birthDayDict[key] > 5:
-                    familyName = str(self.individuals[fam.husb].name).split()[-1]
-                    self.all_errors += ["US14: The {} family has more than five children born at the same time".format(familyName)]
+                    familyName = str(self.name(fam.husb)).split()[-1]
+                    self.add_error("US14: The {} family has more than five children born at the same time".format(familyName))
 
 
     def too_many_siblings(self):
         """US15: Tests to ensure that there are fewer than 15 siblings in a family"""
         for fam in self.family.values():
             if len(fam.chil)>=15:
-                familyName = str(self.individuals[fam.husb].name).split()[-1]
-                self.all_errors+=["US15: The {} family has 15 or more siblings".format(familyName)]
+                familyName = str(self.name(fam.husb)).split()[-1]
+                self.add_error("US15: The {} family has 15 or more siblings".format(familyName))
 
-    def descendants_help(self, initial_indi, current_indi ):
-        """Recursive helper for US17"""
-        if(len(current_indi.fams)>0):
+    def descendants_help(self, initial_indi, children):
+        """Helper for US17: walks down from the children with a stack, each descendant is visited once so someone listed
+           as a child of their own family (a cycle in bad data) cannot loop forever"""
+        stack, visited = list(children), set()
+        while stack:
+            child = stack.pop()
+            if child in visited:
+                continue
+            visited.add(child)
+            current_indi = self.individuals[child]
             for fam in current_indi.fams:
-                if (self.individuals[self.family[fam].husb] == initial_indi or self.individuals[self.family[fam].wife] == initial_indi):
-                    self.all_errors+=["US17: {} cannot be married to their descendant {}".format(initial_indi.name, current_indi.name)]
-                for child in self.family[fam].chil:
-                    self.descendants_help(initial_indi,self.individuals[child])
+                if (self.individuals.get(self.family[fam].husb) == initial_indi or self.individuals.get(self.family[fam].wife) == initial_indi):
+                    self.add_error("US17: {} cannot be married to their descendant {}".format(initial_indi.name, current_indi.name))
+                stack += self.family[fam].chil
 
     def no_marriage_to_descendants(self):
         """US17: Tests to ensure that individuals and their descendants do not marry each other"""
         for person in self.individuals.values(): #Traverse all individuals and do a top down search of all descendants
             if(len(person.fams)>0):
-                for fam in person.fams:
-                    for child in self.family[fam].chil:
-                        self.descendants_help(person,self.individuals[child])
+                self.descendants_help(person, [child for fam in person.fams for child in self.family[fam].chil])
 
     def no_marriage_to_siblings(self):
         """US18: Tests to ensure that individuals do not marry their siblings"""
@@ -468,82 +1107,52 @@ class CheckForErrors:
                     tempWife = self.family[fam].wife
                     if(person.famc != None):
                         if(tempHusb in self.family[person.famc].chil and self.individuals[tempHusb] != person and [self.individuals[tempHusb].name,person.name] not in couples):
-                            self.all_errors +=["US18: {} cannot be married to their sibling {}".format(person.name, self.individuals[tempHusb].name)]
+                            self.add_error("US18: {} cannot be married to their sibling {}".format(person.name, self.individuals[tempHusb].name))
                             couples.append([person.name,self.individuals[tempHusb].name])
                         elif(tempWife in self.family[person.famc].chil and self.individuals[tempWife] != person and [self.individuals[tempWife].name,person.name] not in couples):
-                            self.all_errors +=["US18: {} cannot be married to their sibling {}".format(person.name, self.individuals[tempWife].name)]
+                            self.add_error("US18: {} cannot be married to their sibling {}".format(person.name, self.individuals[tempWife].name))
                             couples.append([person.name,self.individuals[tempWife].name])
                             
     def no_marriage_to_cousin(self):
         """US19: Tests to ensure that individuals do not marry their first cousins"""
-        couples = []
         for fam in self.family.values():
-            mom = fam.wife
-            dad = fam.husb
-            for currIndi in fam.chil:
-                if self.individuals[mom].famc != None:
-                    for auntUncle in self.family[self.individuals[mom].famc].chil:    #mom's siblings
-                        for cousin in self.get_childrenID(auntUncle):                   #cousin's on mom's side
-                            if self.get_spouse(cousin) == currIndi and [currIndi,cousin] not in couples:
-                                self.all_errors+=["US19: {} cannot be married to their cousin {}".format(self.individuals[currIndi].name, self.individuals[cousin].name)]
-                                couples.append([cousin,currIndi])
-                if self.individuals[dad].famc != None:
-                    for auntUncle in self.family[self.individuals[dad].famc].chil:  #dad's siblings
-                        for cousin in self.get_childrenID(auntUncle):               #cousins on dad's side
-                            if self.get_spouse(cousin) == currIndi and [currIndi,cousin] not in couples:
-                                self.all_errors+=["US19: {} cannot be married to their cousin {}".format(self.individuals[currIndi].name, self.individuals[cousin].name)]
-                                couples.append( [cousin,currIndi])
-
-    def get_childrenID(self, indi_ID):
-        """returns a list of children IDs of the given individual ID"""
-        childrenLst = []
-        #an indivual can remarry and therefore have multiple families, hence the loop
-        for family in self.individuals[indi_ID].fams:
-            if len(self.family[family].chil) != 0:
-                childrenLst += self.family[family].chil
-        return childrenLst
-
-    def get_spouse(self, indi_ID):
-        """returns the current spouse of the given individual ID"""
-        for family in self.individuals[indi_ID].fams:
-            if self.family[family].div == None:
-                if self.individuals[indi_ID].sex == "M":
-                    return self.family[family].wife
-                else:
-                    return self.family[family].husb
+            if fam.husb == None or fam.wife == None:
+                continue
+            common = self.ancestry.common_ancestor(fam.husb, fam.wife, 4)   #cousins and aunts are at most 4 generations apart
+            if common != None and common[1:] == (2, 2):     #both are grandchildren of the closest common ancestor
+                self.add_errors_if_new("US19: {} cannot be married to their cousin {}".format(self.individuals[fam.husb].name, self.individuals[fam.wife].name))
 
     def creepy_aunts_and_uncles(self):
         """US20: Ensures that aunts and uncles should not marry their nieces or nephews"""
-        #go through set of children from each family,
-        # then go through children of each sibling to make sure they are not married to the other siblings
+        #the niece or nephew is a grandchild of the closest common ancestor and the aunt or uncle is a child of it
         for fam in self.family.values():
-            siblingIDs = fam.chil #set of sibling IDs
-            if len(siblingIDs) != 0: #if there are siblings
-                for sib in siblingIDs: #string for the sibling ID
-                    for child in self.get_childrenID(sib):
-                        if self.get_spouse(child) in siblingIDs:
-                            self.all_errors += ["US20: {} is married to their aunt or uncle".format(self.individuals[child].name)]
-
-
+            if fam.husb == None or fam.wife == None:
+                continue
+            common = self.ancestry.common_ancestor(fam.husb, fam.wife, 3)
+            if common != None and common[1:] in [(1, 2), (2, 1)]:
+                child = fam.wife if common[2] == 2 else fam.husb
+                self.add_error("US20: {} is married to their aunt or uncle".format(self.individuals[child].name))
 
     def correct_gender_role(self):
         """US21: Husband in family should be male and wife in family should be female"""
         for fam in self.family.values():
-            familyName = str(self.individuals[fam.husb].name).split()[-1].strip("/")
-            husband = self.individuals[fam.husb]
-            wife = self.individuals[fam.wife]
-            if husband.sex == "F":
-                self.all_errors += ["US21: The husband in the {} family, ({}), is a female!".format(familyName, husband.name)]
-            if wife.sex == "M":
-                self.all_errors += ["US21: The wife in the {} family, ({}), is a male!".format(familyName, wife.name)]
+            familyName = str(self.name(fam.husb)).split()[-1].strip("/")
+            husband = self.individuals.get(fam.husb)
+            wife = self.individuals.get(fam.wife)
+            if husband != None and husband.sex == "F":
+                self.add_error("US21: The husband in the {} family, ({}), is a female!".format(familyName, husband.name))
+            if wife != None and wife.sex == "M":
+                self.add_error("US21: The wife in the {} family, ({}), is a male!".format(familyName, wife.name))
 
 
     def unique_names_and_bdays(self):
         """US23: Tests to ensure there are no individuals with the same name and birthdate"""
         names_and_bdays = []
         for person in self.individuals.values():
+            if person.birt == None:         #people without a birth date can not be told apart by it
+                continue
             if (person.name, person.birt) in names_and_bdays:
-                self.all_errors += ["US23: An idividual with the name: {}, and birthday: {}, already exists!".format(person.name, person.birt)]
+                self.add_error("US23: An idividual with the name: {}, and birthday: {}, already exists!".format(person.name, person.birt))
             else:
                 names_and_bdays += [(person.name, person.birt)]
 
@@ -553,10 +1162,12 @@ class CheckForErrors:
             and marriage date"""
         unique_families = [] # input in the form (husband name, wife name, marriage date)
         for family in self.family.values():
+            if family.husb == None or family.wife == None:
+                continue
             husb_name = self.individuals[family.husb].name
             wife_name = self.individuals[family.wife].name
             if (husb_name, wife_name, family.marr) in unique_families:
-                self.all_errors += ["US24: The family with spouses {} and {} married on {} occurs more than once in the GEDCOM file.".format(husb_name, wife_name, family.marr)]
+                self.add_error("US24: The family with spouses {} and {} married on {} occurs more than once in the GEDCOM file.".format(husb_name, wife_name, family.marr))
             else:
                 unique_families += [(husb_name, wife_name, family.marr)]
 
@@ -567,8 +1178,10 @@ class CheckForErrors:
             for child in family.chil:
                 child_name = self.individuals[child].name
                 child_bday = self.individuals[child].birt
+                if child_bday == None:
+                    continue
                 if (child_name, child_bday) in unique_child_names:
-                    self.all_errors += ["US25: There is more than one child with the name {} and birthdate {} in family {}".format(child_name, child_bday, ID)]
+                    self.add_error("US25: There is more than one child with the name {} and birthdate {} in family {}".format(child_name, child_bday, ID))
                 else:
                     unique_child_names += [(child_name, child_bday)]
 
@@ -576,71 +1189,69 @@ class CheckForErrors:
         """US27: This method ensures that the people are being listed with proper ages in the table
             This simply ensures the calculation for age correctly by checking one person's name
             John /Old/ was born in 1007 and died in 2007"""
-        for individual in self.individuals.values():
+        for ID, individual in self.individuals.items():
+            age = self.ages[ID].calendar_years if ID in self.ages else None
             if individual.name == 'John /Old/':
-                if individual.age == 1000:
-                    self.all_errors += ["US27: {} calculated age is {} == 1000 years old".format(individual.name, individual.age)] 
+                if age == 1000:
+                    self.add_error("US27: {} calculated age is {} == 1000 years old".format(individual.name, age))
             elif individual.name == "Jess /Eff/": #known birthday and not known death date
-                if individual.age == 51:
-                    self.all_errors += ["US27: {} calculated age is {} == 51 years old".format(individual.name, individual.age)]
+                if age == 51:
+                    self.add_error("US27: {} calculated age is {} == 51 years old".format(individual.name, age))
 
     def order_siblings_oldest_to_youngest(self):
         """US28: This method will order the siblings in each family from oldest to youngest"""
         for ID, family in self.family.items():
-            listed_siblings_ID = list(family.chil) #list of sibling ID
+            listed_siblings_ID = self.sorted_children[ID] #list of sibling ID
             listed_siblings_obj = [self.individuals[indi] for indi in listed_siblings_ID] #list of sibling Individual() object
-            sorted_siblings = sorted(listed_siblings_obj, key=lambda x: x.birt, reverse=False) #list of sibling Individual() object sorted on age
+            sorted_siblings = sorted(listed_siblings_obj, key=lambda x: (x.birt == None, x.birt or datetime.date.min), reverse=False) #list of sibling Individual() object sorted on age, unknown births last
             sorted_names = [sibling.name for sibling in sorted_siblings] #list of siblings names in order of age
             if len(sorted_names) > 1: #only lists if there is more than one sibling
-                self.all_errors += ["US28: The children in family {} from oldest to youngest are {}".format(ID, sorted_names)]
+                self.add_error("US28: The children in family {} from oldest to youngest are {}".format(ID, sorted_names))
 
     def list_deceased(self):
         """US29: This method lists all of the deceased people in the GEDCOM file"""
         for person in self.individuals.values():
             if person.deat != None:
-                self.all_errors += ["US29: {} is deceased".format(person.name)]
+                self.add_error("US29: {} is deceased".format(person.name))
 
     def list_living_married(self):
         """US30: This method lists all of the living married people in the GEDCOM file"""
         for family in self.family.values():
             if family.div != None:
-                self.add_errors_if_new("US30: {} is alive and married".format(self.individuals[family.husb].name))
-                self.add_errors_if_new("US30: {} is alive and married".format(self.individuals[family.wife].name))
+                for spouse in (family.husb, family.wife):
+                    if spouse != None:
+                        self.add_errors_if_new("US30: {} is alive and married".format(self.individuals[spouse].name))
                 
     def list_living_single(self):
         """US31: This method lists all living people over 30 who have never been married in the GEDCOM file"""
-        for person in self.individuals.values():
-            if person.age > 30 and len(person.fams) == 0 and person.deat == None:
+        for ID, person in self.individuals.items():
+            if person.deat == None and len(person.fams) == 0 and ID in self.ages and self.ages[ID].years > 30:
                 self.add_errors_if_new("US31: {} is single and alive".format(person.name))
 
     def list_multiple_births(self):
         """US32: This method lists all multiple births in a family"""
-        for fam in self.family.values():
-            childIDLstCopy = deepcopy(list(fam.chil))
-            childIDLstCopy.sort() #needs to be sorted since every time the program runs, the order of the children set changes
+        for ID, fam in self.family.items():
+            childIDLstCopy = self.sorted_children[ID] #sorted since every time the program runs, the order of the children set changes
 
             birthDayDict = {}
             for i in range(len(childIDLstCopy)):
                 child = self.individuals[childIDLstCopy[i]]
+                if child.birt == None:      #children without a birth date were not born at the same time as anyone
+                    continue
                 if child.birt not in birthDayDict:
                     birthDayDict[child.birt] = 1
                 else:
                     birthDayDict[child.birt] = birthDayDict[child.birt] + 1
             for key in birthDayDict:
                 if birthDayDict[key] > 1:
-                    familyName = str(self.individuals[fam.husb].name).split()[-1]
+                    familyName = str(self.name(fam.husb)).split()[-1]
                     self.add_errors_if_new("US32: The {} family has had {} children born at the same time".format(familyName, birthDayDict[key]))
                 
     def list_anniversaries(self):
         """US39: This method lists all upcoming anniversaries in the next 30 days"""
-        for fam in self.family.values():
-            anniversary1 = fam.marr.replace(year = datetime.date.today().year)
-            anniversary2 = fam.marr.replace(year = datetime.date.today().year + 1)
-            ann1Time = (anniversary1 - datetime.date.today()).days
-            ann2Time = (anniversary2 - datetime.date.today()).days
-            
-            if((ann1Time < 30 and ann1Time > 0) or (ann2Time < 30 and ann2Time > 0)):
-                self.all_errors += ["US39: {} and {} have an anniversary coming within the next 30 days.".format(self.individuals[fam.husb].name,self.individuals[fam.wife].name, str(min(ann1Time,ann2Time)))]
+        for ID, anniversary in self.anniversaries.within(self.as_of + datetime.timedelta(days = 1), 28): #1 to 29 days from as_of
+            fam = self.family[ID]
+            self.add_error("US39: {} and {} have an anniversary coming within the next 30 days.".format(self.name(fam.husb),self.name(fam.wife)))
                 
     def check_date(self,date):
         """helper for illegitimate dates"""
@@ -662,11 +1273,41 @@ class CheckForErrors:
             if(indi.div != None):
                 self.check_date(fam.div)
         
+    def add_error(self, error):
+        """Every user story reports its messages through here so a budgeted run can stop a rule once its story
+            has used up its limit, and stop the whole run once max_errors messages were found.
+            The budget is checked before the message is kept so a message is never kept over its limit"""
+        if not self.budgeted:
+            self.all_errors += [error]
+            return
+        stories = error.split(":", 1)[0].split(" & ")
+        if self.max_errors != None and len(self.all_errors) >= self.max_errors:
+            raise BudgetExhausted(True)
+        if any(self.used_up(story) for story in stories):
+            raise BudgetExhausted(False)
+        self.all_errors += [error]
+        self.count_error(error)
+        if self.max_errors != None and len(self.all_errors) >= self.max_errors:
+            raise BudgetExhausted(True)         #stop as soon as the budget is reached instead of at the next message
+        if any(self.used_up(story) for story in stories):
+            raise BudgetExhausted(False)
+
+    def used_up(self, story):
+        """Returns True if the story has a limit and reported that many messages"""
+        return story in self.limits and self.counts[story] >= self.limits[story]
+
+    def count_error(self, error):
+        """Counts a message against the stories in its prefix, e.g. "US05 & US06: ..." and returns those stories"""
+        stories = error.split(":", 1)[0].split(" & ")
+        for story in stories:
+            self.counts[story] += 1
+        return stories
+
     def add_errors_if_new(self, error):
         """This method is here to add errors to the error list if they do not occur, in order to ensure no duplicates.
             Some user stories may flag duplicate errors and this method eliminates the issue."""
         if error not in self.all_errors:
-            self.all_errors += [error]
+            self.add_error(error)
 
     def print_errors(self):
         """After all error messages have been compiled into the list of errors the program prints them all out"""
@@ -676,6 +1317,32 @@ class CheckForErrors:
             for error in sorted(self.all_errors):
                 print(error)
 
+def read_records(file_name):
+    """Streams a GEDCOM file one level 0 record at a time without parsing it. Yields (ID, record tag, list of the record's lines),
+       the ID is None for records without one such as HEAD and TRLR"""
+    try:
+        fp = open(file_name, 'r', errors = "replace")   #same as read_files so both accept the same files
+    except FileNotFoundError:
+        raise FileNotFoundError ("Could not open {}".format(file_name))
+    with fp:
+        lines = []
+        for line in fp:
+            line = line.strip()
+            if line.startswith("0 ") and lines:
+                yield record_header(lines) + (lines,)
+                lines = []
+            if line:
+                lines.append(line)
+        if lines:
+            yield record_header(lines) + (lines,)
+
+def record_header(lines):
+    """Returns (ID, record tag) from the first line of a record"""
+    parts = lines[0].split(" ", 2)
+    if len(parts) == 3 and parts[1].startswith("@"):
+        return parts[1].replace("@", ""), parts[2].strip()
+    return None, parts[1] if len(parts) > 1 else ""
+
 def main():
     """This method runs the program"""
     cwd = os.path.dirname(os.path.abspath(__file__)) #gets directory of the file
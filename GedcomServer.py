@@ -0,0 +1,397 @@
+"""A long running local service that keeps parsed GEDCOM trees in memory and answers validate, lookup,
+relatives and relationship queries over HTTP on localhost or a Unix socket, so a file is only parsed once"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from GedcomProject import AnalyzeGEDCOM, CheckForErrors, AncestryIndex
+
+worker_trees = None                 #TreeCache of the trees parsed in this worker process, see in_worker
+worker_lock = threading.Lock()      #the workers are threads when the service is given a ThreadPoolExecutor
+
+def in_worker(function, memory_budget, *args):
+    """Runs in a worker: calls the function with the worker's tree cache set up to memory_budget bytes. Returns its result
+       with the worker's process ID and (bytes used, list of (file name, size)) of the trees the worker holds"""
+    global worker_trees
+    with worker_lock:
+        if worker_trees is None:
+            worker_trees = TreeCache(memory_budget)
+    result = function(*args)
+    with worker_lock:
+        held = (worker_trees.used, [(tree.file_name, tree.size) for tree in worker_trees.trees.values()])
+    return result, os.getpid(), held
+
+def worker_tree(file_name):
+    """Runs in a worker: returns this worker's copy of the tree, parsing the file if the worker has not loaded it
+       since it last changed. The parsed records are only kept in the workers, the event loop only sends file names"""
+    with worker_lock:
+        tree = worker_trees.get(file_name)
+    if tree is None:
+        mtime = os.path.getmtime(file_name)
+        parsed = AnalyzeGEDCOM(file_name, create_tables = False, print_errors = False, stories = set())
+        tree = LoadedTree(file_name, mtime, parsed.individuals, parsed.family, parsed.errors)
+        with worker_lock:
+            worker_trees.add(tree)
+    return tree
+
+def load_tree(file_name):
+    """Runs in a worker: parses the file without running any user stories, returns the modification time it was parsed at"""
+    return worker_tree(file_name).mtime
+
+def validate_tree(file_name, stories, as_of, max_errors, fail_fast):
+    """Runs in a worker: runs the requested user stories (all if stories is None) over the worker's copy of the tree,
+       returns the errors and whether the error budget stopped the run early"""
+    tree = worker_tree(file_name)
+    checker = CheckForErrors(tree.individuals, tree.family, list(tree.errors), False, stories, as_of, max_errors, fail_fast = fail_fast)
+    return checker.all_errors, checker.budget_exhausted
+
+def lookup_record(file_name, ID):
+    """Runs in a worker: returns the individual or family record with that ID as JSON, None if there is none"""
+    tree = worker_tree(file_name)
+    if ID in tree.individuals:
+        return dict(record_json(ID, tree.individuals[ID]), type = "INDI")
+    if ID in tree.family:
+        return dict(record_json(ID, tree.family[ID]), type = "FAM")
+    return None
+
+def tree_relatives(file_name, ID):
+    """Runs in a worker: returns the parents, siblings, spouses and children of an individual, None if there is no such individual"""
+    tree = worker_tree(file_name)
+    if ID not in tree.individuals:
+        return None
+    indi = tree.individuals[ID]
+    parents, siblings, spouses, children = set(), set(), set(), set()
+    if indi.famc in tree.family:
+        parents = {tree.family[indi.famc].husb, tree.family[indi.famc].wife} - {None}
+        siblings = tree.family[indi.famc].chil - {ID}
+    for fam in indi.fams:
+        if fam in tree.family:
+            spouses |= {tree.family[fam].husb, tree.family[fam].wife} - {None, ID}
+            children |= tree.family[fam].chil
+    return {"id": ID, "parents": sorted(parents), "siblings": sorted(siblings), "spouses": sorted(spouses), "children": sorted(children)}
+
+def tree_relationships(file_name, a, others):
+    """Runs in a worker: returns (None, the Relationship of each of others to a), or (ID, None) for the first ID that is
+       not an individual. The AncestryIndex is built by the first query and kept with the worker's copy of the tree"""
+    tree = worker_tree(file_name)
+    for ID in [a] + others:
+        if ID not in tree.individuals:
+            return ID, None
+    with worker_lock:
+        if tree.ancestry is None:
+            tree.ancestry = AncestryIndex(tree.individuals, tree.family)
+            worker_trees.resize(tree, estimate_ancestry_size(tree.ancestry))
+        return None, tree.ancestry.relationships((a, b) for b in others)
+
+def record_json(ID, record):
+    """Turns an Individual or Family into something that can be written as JSON"""
+    result = {"id": ID}
+    for key, value in record.__dict__.items():
+        if isinstance(value, set):
+            value = sorted(value)
+        elif isinstance(value, datetime.date):
+            value = value.isoformat()
+        result[key] = value
+    return result
+
+def estimate_size(individuals, family):
+    """Rough number of bytes used by a parsed tree, used to keep the cache inside its memory budget"""
+    size = sys.getsizeof(individuals) + sys.getsizeof(family)
+    for records in (individuals, family):
+        for ID, record in records.items():
+            size += sys.getsizeof(ID) + sys.getsizeof(record) + sys.getsizeof(record.__dict__)
+            size += sum(sys.getsizeof(value) for value in record.__dict__.values())
+    return size
+
+def estimate_ancestry_size(ancestry):
+    """Rough number of bytes added by an AncestryIndex, the records it points to are counted with the tree"""
+    size = sys.getsizeof(ancestry.parents) + sys.getsizeof(ancestry.depth) + sys.getsizeof(ancestry.line)
+    return size + sum(sys.getsizeof(parents) for parents in ancestry.parents.values())
+
+def estimate_result_size(result):
+    """Rough number of bytes used by a validation result kept in the cache"""
+    errors, exhausted = result
+    return sys.getsizeof(result) + sys.getsizeof(errors) + sum(sys.getsizeof(error) for error in errors)
+
+
+class LoadedTree:
+    """This stores one parsed GEDCOM file held by a worker"""
+    def __init__(self, file_name, mtime, individuals, family, errors):
+        self.file_name = file_name
+        self.mtime = mtime              #modification time of the file when it was parsed, a newer file is parsed again
+        self.individuals = individuals
+        self.family = family
+        self.errors = errors            #errors found while parsing (US22 and US42)
+        self.size = estimate_size(individuals, family)
+        self.ancestry = None            #AncestryIndex, built by the first relationship query
+
+
+class KnownFile:
+    """This stores what the event loop keeps about a file the workers have parsed, the records stay in the workers"""
+    def __init__(self, file_name, mtime):
+        self.file_name = file_name
+        self.mtime = mtime              #modification time of the file when it was parsed, a newer file is parsed again
+        self.size = 0                   #bytes of the results kept
+        self.results = OrderedDict()    #Key = (frozenset of stories or None for all, as_of, max_errors, fail_fast) Value = (errors, budget exhausted)
+
+
+class TreeCache:
+    """Least recently used cache of loaded trees (or of the KnownFile results of the event loop) that evicts the oldest
+       trees once the memory budget is used up"""
+    MAX_RESULTS = 32                    #validation results kept per tree, the least recently used are dropped first
+
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+        self.trees = OrderedDict()      #Key = absolute file name Value = LoadedTree, least recently used first
+        self.used = 0
+
+    def get(self, file_name):
+        """Returns the tree for the file if it is loaded and still up to date, None otherwise"""
+        tree = self.trees.get(file_name)
+        if tree is None:
+            return None
+        if tree.mtime != os.path.getmtime(file_name):
+            self.remove(file_name)
+            return None
+        self.trees.move_to_end(file_name)
+        return tree
+
+    def add(self, tree):
+        """Stores the tree, evicting the least recently used trees until it fits. A tree bigger than the whole
+           budget is still returned to the caller but it is not kept"""
+        self.remove(tree.file_name)
+        if tree.size > self.memory_budget:
+            return
+        while self.used + tree.size > self.memory_budget:
+            self.remove(next(iter(self.trees)))
+        self.trees[tree.file_name] = tree
+        self.used += tree.size
+
+    def remove(self, file_name):
+        """Forgets the tree for the file if it is loaded"""
+        tree = self.trees.pop(file_name, None)
+        if tree is not None:
+            self.used -= tree.size
+
+    def resize(self, tree, change):
+        """Counts bytes added to (or removed from) a cached tree, evicting the least recently used trees, the tree
+           itself last, until the budget is kept. A tree that is not cached is not counted"""
+        if self.trees.get(tree.file_name) is not tree:
+            return
+        tree.size += change
+        self.used += change
+        while self.used > self.memory_budget:
+            self.remove(next(iter(self.trees)))
+
+    def get_result(self, tree, key):
+        """Returns the validation result kept with the tree for the key, None if it is not kept"""
+        if key not in tree.results:
+            return None
+        tree.results.move_to_end(key)
+        return tree.results[key]
+
+    def add_result(self, tree, key, result):
+        """Keeps a validation result with the tree, counted against the memory budget. Only the last MAX_RESULTS
+           results of a tree are kept"""
+        if self.trees.get(tree.file_name) is not tree:
+            return
+        while len(tree.results) >= self.MAX_RESULTS:
+            self.resize(tree, -estimate_result_size(tree.results.pop(next(iter(tree.results)))))
+        tree.results[key] = result
+        self.resize(tree, estimate_result_size(result))
+
+
+class RequestError(Exception):
+    """Raised by a handler to answer a request with an HTTP error status"""
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+class GedcomServer:
+    """This class answers the HTTP requests, every query runs in a worker pool so the event loop stays responsive. The
+       workers hold the parsed trees, the event loop only keeps the validation results. The memory budget is shared
+       evenly between the event loop and each worker process"""
+    REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+    def __init__(self, memory_budget = 512 * 1024 * 1024, executor = None):
+        self.executor = executor if executor is not None else ProcessPoolExecutor()
+        #threads share one worker cache, each worker process has its own
+        processes = self.executor._max_workers if isinstance(self.executor, ProcessPoolExecutor) else 1
+        self.memory_budget = memory_budget
+        self.worker_budget = memory_budget // (processes + 1)
+        self.cache = TreeCache(self.worker_budget)  #KnownFile of each file, with its results
+        self.workers = dict()           #Key = worker process ID Value = (bytes used, list of (file name, size)) as last reported
+        self.executor.submit(int).result()  #starts the workers now, a worker forked while answering a request would keep its connection open
+        self.loading = dict()           #Key = file name Value = future of a load in progress, shared by concurrent requests
+        self.routes = {"/validate": self.validate, "/lookup": self.lookup, "/relatives": self.relatives,
+                       "/relationship": self.relationship, "/trees": self.trees}
+
+    async def start(self, host = "127.0.0.1", port = 0, path = None):
+        """Starts listening on a TCP port of the host, or on a Unix socket if a path is given, and returns the asyncio server"""
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle_connection, path = path)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def run_in_worker(self, function, *args):
+        """Runs a function in the worker pool and notes what the worker that ran it holds"""
+        result, worker, held = await asyncio.get_running_loop().run_in_executor(self.executor, in_worker, function, self.worker_budget, *args)
+        self.workers[worker] = held
+        return result
+
+    async def get_tree(self, file_name):
+        """Returns the KnownFile for the file, parsing it in the worker pool if it is not known yet"""
+        file_name = os.path.abspath(file_name)
+        if not os.path.isfile(file_name):
+            raise RequestError(404, "Could not open {}".format(file_name))
+        tree = self.cache.get(file_name)
+        if tree is not None:
+            return tree
+        if file_name not in self.loading:
+            self.loading[file_name] = asyncio.ensure_future(self.load(file_name))
+        return await asyncio.shield(self.loading[file_name])
+
+    async def load(self, file_name):
+        """Parses the file in the worker pool and remembers it in the cache"""
+        try:
+            tree = KnownFile(file_name, await self.run_in_worker(load_tree, file_name))
+            self.cache.add(tree)
+            return tree
+        finally:
+            del self.loading[file_name]
+
+    async def validate(self, query):
+        """GET /validate?file=NAME[&stories=US01,US02][&as_of=YYYY-MM-DD][&max_errors=N][&fail_fast=1]: the errors found in the
+           file on the as_of date (today by default). fail_fast only answers whether the file has an error"""
+        tree = await self.get_tree(self.argument(query, "file"))
+        stories = None
+        if "stories" in query:
+            stories = frozenset(story for story in query["stories"][0].split(",") if story)
+            try:
+                CheckForErrors.select_rules(stories)
+            except ValueError as error:
+                raise RequestError(400, str(error))
+        as_of = datetime.date.today()
+        if "as_of" in query:
+            try:
+                as_of = datetime.date.fromisoformat(query["as_of"][0])
+            except ValueError:
+                raise RequestError(400, "as_of must be a YYYY-MM-DD date")
+        max_errors = None
+        if "max_errors" in query:
+            try:
+                max_errors = int(query["max_errors"][0])
+            except ValueError:
+                raise RequestError(400, "max_errors must be a number")
+        fail_fast = query.get("fail_fast", ["0"])[0] not in ("0", "false", "")
+        key = (stories, as_of, max_errors, fail_fast)
+        result = self.cache.get_result(tree, key)
+        if result is None:
+            result = await self.run_in_worker(validate_tree, tree.file_name, stories, as_of, max_errors, fail_fast)
+            self.cache.add_result(tree, key, result)
+        errors, exhausted = result
+        return {"file": tree.file_name, "as_of": as_of.isoformat(), "errors": errors, "budget_exhausted": exhausted}
+
+    async def lookup(self, query):
+        """GET /lookup?file=NAME&id=ID: the individual or family record with that ID"""
+        tree = await self.get_tree(self.argument(query, "file"))
+        ID = self.argument(query, "id")
+        record = await self.run_in_worker(lookup_record, tree.file_name, ID)
+        if record is None:
+            raise RequestError(404, "There is no individual or family with the ID {}".format(ID))
+        return record
+
+    async def relatives(self, query):
+        """GET /relatives?file=NAME&id=ID: the parents, siblings, spouses and children of an individual"""
+        tree = await self.get_tree(self.argument(query, "file"))
+        ID = self.argument(query, "id")
+        relatives = await self.run_in_worker(tree_relatives, tree.file_name, ID)
+        if relatives is None:
+            raise RequestError(404, "There is no individual with the ID {}".format(ID))
+        return relatives
+
+    async def relationship(self, query):
+        """GET /relationship?file=NAME&a=ID&b=ID[&b=ID...]: what each b is to a, e.g. 1st cousin once removed"""
+        tree = await self.get_tree(self.argument(query, "file"))
+        a, others = self.argument(query, "a"), query.get("b", [])
+        missing, relationships = await self.run_in_worker(tree_relationships, tree.file_name, a, others)
+        if missing is not None:
+            raise RequestError(404, "There is no individual with the ID {}".format(missing))
+        return {"a": a, "relationships": [dict(relationship._asdict(), b = b) for b, relationship in zip(others, relationships)]}
+
+    async def trees(self, query):
+        """GET /trees: the trees held by each worker, least recently used first, and the memory used by the workers
+           and the results kept by the event loop, as last reported by each worker"""
+        trees = [{"file": file_name, "size": size, "worker": worker}
+                 for worker, (used, held) in sorted(self.workers.items()) for file_name, size in held]
+        used = self.cache.used + sum(used for used, held in self.workers.values())
+        return {"budget": self.memory_budget, "used": used, "results": self.cache.used, "trees": trees}
+
+    def argument(self, query, name):
+        """Returns a required query string argument"""
+        if name not in query:
+            raise RequestError(400, "Missing the {} argument".format(name))
+        return query[name][0]
+
+    async def handle_connection(self, reader, writer):
+        """Reads one HTTP request from the connection and writes the JSON answer"""
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass                    #the headers are not needed, every route is a GET with a query string
+            status, body = await self.dispatch(request_line)
+            payload = json.dumps(body).encode("utf-8")
+            writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+                         .format(status, self.REASONS[status], len(payload)).encode("latin-1") + payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def dispatch(self, request_line):
+        """Calls the handler for the request and returns the status and the body to answer with"""
+        if len(request_line) != 3:
+            return 400, {"error": "Malformed request line"}
+        method, target, version = request_line
+        if method != "GET":
+            return 405, {"error": "Only GET is supported"}
+        url = urlsplit(target)
+        if url.path not in self.routes:
+            return 404, {"error": "Unknown path {}".format(url.path)}
+        try:
+            return 200, await self.routes[url.path](parse_qs(url.query))
+        except RequestError as error:
+            return error.status, {"error": str(error)}
+        except Exception as error:
+            return 500, {"error": "{}: {}".format(type(error).__name__, error)}
+
+
+async def serve(host, port, path, memory_budget, workers):
+    """Runs the service until it is interrupted"""
+    server = GedcomServer(memory_budget, ProcessPoolExecutor(workers))
+    listener = await server.start(host, port, path)
+    print("Listening on {}".format(path if path is not None else "http://{}:{}".format(*listener.sockets[0].getsockname()[:2])))
+    async with listener:
+        await listener.serve_forever()
+
+def main():
+    """This method runs the service"""
+    parser = argparse.ArgumentParser(description = "Keeps GEDCOM trees in memory and answers validate, lookup and relatives queries")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8555)
+    parser.add_argument("--unix", help = "listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--budget-mb", type = int, default = 512, help = "memory budget for the trees held in memory")
+    parser.add_argument("--workers", type = int, default = None, help = "number of worker processes")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.budget_mb * 1024 * 1024, args.workers))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Aggregate statistics over parsed GEDCOM trees for dashboards: births and deaths per decade, mean marriage age, family sizes,
+lifespans and surname frequencies. Every metric is gathered in one pass over the individuals and one over the families, and
+partial results of several files or shards can be added together"""
+import argparse
+from collections import Counter, defaultdict
+from GedcomProject import AnalyzeGEDCOM, TreeIndex, exact_age
+
+DAYS_PER_YEAR = 365.2425
+
+def decade(date):
+    """Returns the first year of the decade of a date, e.g. 1960 for 8 FEB 1969"""
+    return date.year // 10 * 10
+
+
+class TreeStatistics:
+    """This class holds counters that can be merged: adding the statistics of two trees gives the statistics of both"""
+    GROUPS = ("surname", "decade")
+
+    def __init__(self):
+        self.individuals = 0
+        self.families = 0
+        self.births = Counter()         #Key = decade Value = number of births
+        self.deaths = Counter()         #Key = decade Value = number of deaths
+        self.marriage_days = 0          #sum of the ages in days of the spouses on their wedding day
+        self.marriages = 0              #number of spouses counted in marriage_days
+        self.family_sizes = Counter()   #Key = number of children Value = number of families
+        self.lifespans = Counter()      #Key = lifespan in years rounded down to 10 Value = number of deceased people
+        self.surnames = Counter()       #Key = normalized surname Value = number of people
+
+    def add_individual(self, indi):
+        """Counts one individual"""
+        self.individuals += 1
+        if indi.birt != None:
+            self.births[decade(indi.birt)] += 1
+        if indi.deat != None:
+            self.deaths[decade(indi.deat)] += 1
+            if indi.birt != None and indi.birt <= indi.deat:
+                self.lifespans[exact_age(indi.birt, indi.deat).years // 10 * 10] += 1
+        surname = TreeIndex.surname(indi.name)
+        if surname != None:
+            self.surnames[surname] += 1
+
+    def add_family(self, fam):
+        """Counts one family"""
+        self.families += 1
+        self.family_sizes[len(fam.chil)] += 1
+
+    def add_marriage(self, spouse, fam):
+        """Counts the age of one spouse on their wedding day, marriages before the spouse's birth (US02 errors) are left out"""
+        if fam.marr != None and spouse.birt != None and spouse.birt <= fam.marr:
+            self.marriage_days += (fam.marr - spouse.birt).days
+            self.marriages += 1
+
+    @classmethod
+    def from_tree(cls, individuals, family, group_by = None):
+        """Returns the statistics of a parsed tree. With group_by = "surname" or "decade" (of birth) it returns
+           Key = group Value = TreeStatistics instead, people without a surname or birth date are in the None group.
+           A spouse's marriage age goes to their own group and the size of a family to the husband's group"""
+        if group_by not in (None,) + cls.GROUPS:
+            raise ValueError("group_by must be one of {}".format(", ".join(cls.GROUPS)))
+        def group(indi):
+            if indi == None or group_by == None:
+                return None
+            if group_by == "surname":
+                return TreeIndex.surname(indi.name)
+            return decade(indi.birt) if indi.birt != None else None
+        groups = defaultdict(cls)
+        for indi in individuals.values():
+            groups[group(indi)].add_individual(indi)
+        for fam in family.values():
+            husb, wife = individuals.get(fam.husb), individuals.get(fam.wife)
+            groups[group(husb if husb != None else wife)].add_family(fam)
+            for spouse in (husb, wife):
+                if spouse != None:
+                    groups[group(spouse)].add_marriage(spouse, fam)
+        if group_by == None:
+            return groups[None]
+        return dict(groups)
+
+    def merge(self, other):
+        """Adds the counts of other to these statistics and returns them"""
+        self.individuals += other.individuals
+        self.families += other.families
+        self.marriage_days += other.marriage_days
+        self.marriages += other.marriages
+        for counter in ("births", "deaths", "family_sizes", "lifespans", "surnames"):
+            getattr(self, counter).update(getattr(other, counter))
+        return self
+
+    def __add__(self, other):
+        return TreeStatistics().merge(self).merge(other)
+
+    def __radd__(self, other):
+        """Lets sum() start from 0"""
+        return self if other == 0 else self + other
+
+    def __eq__(self, other):
+        return isinstance(other, TreeStatistics) and self.__dict__ == other.__dict__
+
+    def mean_marriage_age(self):
+        """Mean age in years of the spouses on their wedding day, None if no marriage could be counted"""
+        if self.marriages == 0:
+            return None
+        return self.marriage_days / self.marriages / DAYS_PER_YEAR
+
+    def report(self):
+        """Returns the lines of a readable summary"""
+        mean = self.mean_marriage_age()
+        lines = ["Individuals: {}".format(self.individuals), "Families: {}".format(self.families),
+                 "Mean marriage age: {}".format("unknown" if mean == None else "{:.1f}".format(mean))]
+        lines += ["Births in the {}s: {}".format(key, self.births[key]) for key in sorted(self.births)]
+        lines += ["Deaths in the {}s: {}".format(key, self.deaths[key]) for key in sorted(self.deaths)]
+        lines += ["Families with {} children: {}".format(key, self.family_sizes[key]) for key in sorted(self.family_sizes)]
+        lines += ["Lifespans of {} to {} years: {}".format(key, key + 9, self.lifespans[key]) for key in sorted(self.lifespans)]
+        lines += ["Surname {}: {}".format(surname, count) for surname, count in self.surnames.most_common(10)]
+        return lines
+
+
+def merge_groups(*groups):
+    """Merges grouped statistics (Key = group Value = TreeStatistics) of several files or shards"""
+    merged = defaultdict(TreeStatistics)
+    for statistics in groups:
+        for key, value in statistics.items():
+            merged[key].merge(value)
+    return dict(merged)
+
+def file_statistics(file_names, group_by = None):
+    """Parses each file on its own, without running the user stories, and returns the merged statistics"""
+    results = []
+    for file_name in file_names:
+        tree = AnalyzeGEDCOM(file_name, create_tables = False, print_errors = False, stories = set())
+        results.append(TreeStatistics.from_tree(tree.individuals, tree.family, group_by))
+    if group_by == None:
+        return sum(results, TreeStatistics())
+    return merge_groups(*results)
+
+def main():
+    """This method prints the statistics of one or more GEDCOM files"""
+    parser = argparse.ArgumentParser(description = "Shows statistics of GEDCOM files, the files are combined")
+    parser.add_argument("file_names", nargs = "+")
+    parser.add_argument("--group-by", choices = TreeStatistics.GROUPS)
+    args = parser.parse_args()
+    statistics = file_statistics(args.file_names, args.group_by)
+    if args.group_by == None:
+        statistics = {None: statistics}
+    for key in sorted(statistics, key = lambda key: (key == None, key if key != None else 0)):
+        if args.group_by != None:
+            print("{} {}".format(args.group_by.capitalize(), "unknown" if key == None else key))
+        for line in statistics[key].report():
+            print(("    " if args.group_by != None else "") + line)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,19 @@
 import unittest
-from GedcomProject import AnalyzeGEDCOM, Family, Individual, CheckForErrors
+from GedcomProject import AnalyzeGEDCOM, Family, Individual, CheckForErrors, TreeIndex, DayOfYearIndex, AncestryIndex, Age
+from GedcomServer import GedcomServer, TreeCache
+from GedcomDatabase import GedcomDatabase
+from GedcomDiff import GedcomDiff
+from GedcomExtract import GedcomExtract, extract
+from GedcomStatistics import TreeStatistics, file_statistics, merge_groups
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+import contextlib
 import datetime
+import io
+import json
 import os
+import random
+import tempfile
 
 class ProjectTest(unittest.TestCase):
     """Tests that our GEDCOM parser is working properly"""
@@ -10,7 +22,8 @@ class ProjectTest(unittest.TestCase):
         super(ProjectTest, self).__init__(*args, **kwargs)
         cwd = os.path.dirname(os.path.abspath(__file__)) #gets directory of the file
         file_name = cwd + "\Bad_GEDCOM_test_data.ged"
-        self.all_errors = AnalyzeGEDCOM(file_name, False, False).all_errors #done in this method so it only happens once
+        #the known errors were written in the fall of 2018, ages, future dates and upcoming anniversaries are checked on that date
+        self.all_errors = AnalyzeGEDCOM(file_name, False, False, as_of = datetime.date(2018, 11, 15)).all_errors #done in this method so it only happens once
 
     def test_dates_before_curr(self):
         """US01: Unit Test: to ensure that all dates occur before the current date"""
@@ -282,5 +295,695 @@ class ProjectTest(unittest.TestCase):
         for error in list_of_known_errors:
             self.assertIn(error, self.all_errors)
 
+class AsOfTest(unittest.TestCase):
+    """Tests that runs are evaluated on a fixed as_of date and the exact ages computed for it"""
+
+    def setUp(self):
+        self.file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Bad_GEDCOM_test_data.ged")
+
+    def test_reproducible(self):
+        """Tests that two runs on the same as_of date give the same messages and other dates give other messages"""
+        first = AnalyzeGEDCOM(self.file_name, False, False, as_of = datetime.date(2018, 11, 15)).all_errors
+        second = AnalyzeGEDCOM(self.file_name, False, False, as_of = datetime.date(2018, 11, 15)).all_errors
+        self.assertEqual(first, second)
+        later = AnalyzeGEDCOM(self.file_name, False, False, as_of = datetime.date(2030, 1, 1)).all_errors
+        self.assertNotIn("US01: The birth of Future /Trunks/ cannot occur after the current date.", later)
+        self.assertIn("US01: The death of Future /Trunks/ cannot occur after the current date.", later)
+        self.assertNotIn("US39: Art /Versity/ and Ann /Versity/ have an anniversary coming within the next 30 days.", later)
+
+    def test_ages(self):
+        """Tests the exact ages in days and completed years, which depend on whether the birthday has passed"""
+        tree = AnalyzeGEDCOM(self.file_name, False, False, stories = set(), as_of = datetime.date(2018, 3, 7))
+        ages = tree.ages
+        self.assertEqual(ages["I1"], Age((datetime.date(1980, 3, 10) - datetime.date(1969, 2, 8)).days, 11, 11))   #ages stop at death
+        jess = [ID for ID, indi in tree.individuals.items() if indi.name == "Jess /Eff/"][0]
+        self.assertEqual(ages[jess].years, 50)              #born 8 MAR 1967, the day before their 51st birthday
+        self.assertEqual(ages[jess].calendar_years, 51)
+        self.assertEqual(tree.individuals[jess].age, 51)
+        checker = CheckForErrors(tree.individuals, tree.family, [], False, {"US31"}, tree.as_of, ages = tree.ages)
+        self.assertIs(checker.ages, tree.ages)              #the checks reuse the ages computed while parsing
+        indi = Individual()
+        indi.birt = datetime.date(2000, 1, 1)
+        indi.update_age()                                   #today when no date is given
+        self.assertEqual(indi.age, datetime.date.today().year - 2000)
+
+
+class RecordParsingTest(unittest.TestCase):
+    """Tests that places, notes and sources are read from any level of a record"""
+
+    def test_places_notes_and_sources(self):
+        lines = ["0 HEAD", "0 @I1@ INDI", "1 NAME Ann /Lee/", "1 SEX F", "1 BIRT", "2 DATE 3 MAR 1950", "2 PLAC Hoboken, NJ",
+                 "2 SOUR @S1@", "3 PAGE 12", "1 NOTE First line", "2 CONT second line", "2 CONC  continued", "1 FAMS @F1@",
+                 "0 @I2@ INDI", "1 NAME Bob /Lee/", "1 SEX M", "1 BIRT", "2 DATE 4 APR 1948", "1 FAMS @F1@",
+                 "0 @F1@ FAM", "1 HUSB @I2@", "1 WIFE @I1@", "1 MARR", "2 PLAC Boston", "2 DATE 5 JUN 1970", "2 NOTE Small wedding",
+                 "0 @S1@ SOUR", "1 TITL Census", "0 TRLR"]
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "records.ged")
+            with open(file_name, "w") as fp:
+                fp.write("\n".join(lines) + "\n")
+            tree = AnalyzeGEDCOM(file_name, False, False, stories = set())
+        ann, family = tree.individuals["I1"], tree.family["F1"]
+        self.assertEqual((ann.birt, ann.places, ann.sources), (datetime.date(1950, 3, 3), {"BIRT": "Hoboken, NJ"}, ["S1"]))
+        self.assertEqual(ann.notes, ["First line\nsecond line continued"])
+        self.assertEqual((family.marr, family.places, family.notes), (datetime.date(1970, 6, 5), {"MARR": "Boston"}, ["Small wedding"]))
+
+    def test_empty_note(self):
+        """Tests that a NOTE without text starts a new note that its CONT lines continue"""
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "notes.ged")
+            with open(file_name, "w") as fp:
+                fp.write("0 @I1@ INDI\n1 NAME Ann /Lee/\n1 BIRT\n2 DATE 3 MAR 1950\n1 NOTE first\n1 NOTE\n2 CONT second\n1 SOUR\n2 CONC Census\n0 TRLR\n")
+            tree = AnalyzeGEDCOM(file_name, False, False, stories = set())
+        self.assertEqual(tree.individuals["I1"].notes, ["first", "\nsecond"])
+        self.assertEqual(tree.individuals["I1"].sources, ["Census"])
+
+    def test_continuation_of_unread_note(self):
+        """Tests that the CONT and CONC lines of a NOTE or SOUR that is not read are not added to another note"""
+        lines = ["0 @I1@ INDI", "1 NOTE record", "1 NAME A /B/", "2 NOTE n", "3 CONT name more", "2 SOUR @S1@", "3 NOTE c",
+                 "4 CONC  tail", "1 SOUR Census", "2 NOTE x", "3 CONT second", "0 TRLR"]
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "notes.ged")
+            with open(file_name, "w") as fp:
+                fp.write("\n".join(lines) + "\n")
+            tree = AnalyzeGEDCOM(file_name, False, False, stories = set())
+        self.assertEqual((tree.individuals["I1"].notes, tree.individuals["I1"].sources), (["record"], ["Census"]))
+
+class SelectiveRulesTest(unittest.TestCase):
+    """Tests that only the requested user stories are run"""
+
+    def setUp(self):
+        self.file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Bad_GEDCOM_test_data.ged")
+
+    def test_only_requested_stories(self):
+        """Only the requested stories report errors, the US22 and US42 errors found while parsing are always kept"""
+        all_errors = AnalyzeGEDCOM(self.file_name, False, False, stories = {"US02", "US11", "US19"}).all_errors
+        stories = {error.split(":")[0] for error in all_errors}
+        self.assertEqual(stories, {"US02", "US11", "US19", "US22", "US42"})
+        self.assertIn("US11: Matt /Smith/ is practing bigamy", all_errors)
+        self.assertIn("US19: Curr /Two/ cannot be married to their cousin Cuz /One/", all_errors)
+
+    def test_story_categories(self):
+        """Tests that the listing stories can be told apart from the error stories"""
+        self.assertEqual(CheckForErrors.story_ids("listing"), {"US27", "US28", "US29", "US30", "US31", "US32", "US39"})
+        self.assertIn("US06", CheckForErrors.story_ids("error"))
+        all_errors = AnalyzeGEDCOM(self.file_name, False, False, stories = CheckForErrors.story_ids("error")).all_errors
+        self.assertFalse([error for error in all_errors if error.startswith("US29")])
+
+    def test_unknown_story(self):
+        """Tests that asking for a story that does not exist is reported"""
+        with self.assertRaises(ValueError):
+            CheckForErrors.select_rules({"US99"})
+
+class ErrorBudgetTest(unittest.TestCase):
+    """Tests the budgeted runs that stop once enough errors were found"""
+
+    def setUp(self):
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        self.file_name = os.path.join(cwd, "Bad_GEDCOM_test_data.ged")
+        self.good_file = os.path.join(cwd, "GEDCOM_FamilyTree.ged")
+        self.as_of = datetime.date(2018, 11, 15)
+
+    def test_fail_fast(self):
+        """Tests that fail_fast stops at the first error and never runs the listing stories"""
+        tree = AnalyzeGEDCOM(self.good_file, False, False, as_of = self.as_of, fail_fast = True)
+        self.assertEqual(tree.all_errors, ["US10: Barbara /Amitin/ was only 11 years old when they got married"])
+        self.assertTrue(tree.budget_exhausted)
+        tree = AnalyzeGEDCOM(self.file_name, False, False, as_of = self.as_of, fail_fast = True)
+        parse_errors = AnalyzeGEDCOM(self.file_name, False, False, stories = set()).all_errors
+        self.assertEqual(tree.all_errors, parse_errors[:1]) #the first error found while parsing is enough to reject the file
+        self.assertTrue(tree.budget_exhausted)
+        self.assertFalse(AnalyzeGEDCOM(self.good_file, False, False, as_of = self.as_of).budget_exhausted)
+
+    def test_budgets(self):
+        """Tests the global and per story budgets, and that the cheapest rules run first"""
+        tree = AnalyzeGEDCOM(self.file_name, False, False, as_of = self.as_of, max_errors = 20, limits = {"US01": 2})
+        self.assertEqual(len(tree.all_errors), 20)
+        self.assertEqual(len([error for error in tree.all_errors if error.startswith("US01")]), 2)
+        tree = AnalyzeGEDCOM(self.file_name, False, False, stories = {"US23", "US29"}, as_of = self.as_of, max_errors = 7)
+        self.assertEqual(tree.all_errors[6:], ["US29: Mark /Eff/ is deceased"])     #US29 is cheaper than US23
+
+    def test_parse_error_budgets(self):
+        """Tests that the errors found while parsing are cut down to the global and per story budgets, in order"""
+        parse_errors = AnalyzeGEDCOM(self.file_name, False, False, stories = set()).all_errors
+        tree = AnalyzeGEDCOM(self.file_name, False, False, as_of = self.as_of, max_errors = 3)
+        self.assertEqual(tree.all_errors, parse_errors[:3])
+        self.assertTrue(tree.budget_exhausted)
+        tree = AnalyzeGEDCOM(self.file_name, False, False, stories = set(), limits = {"US42": 1})
+        self.assertEqual(tree.all_errors, [parse_errors[0], parse_errors[1], parse_errors[3]])    #the first US42 and both US22
+        with self.assertRaises(ValueError):
+            AnalyzeGEDCOM(self.file_name, False, False, limits = {"US99": 1})
+        tree = AnalyzeGEDCOM(self.file_name, False, False, stories = {"US29", "US31"}, as_of = self.as_of, limits = {"US29": 1})
+        self.assertEqual(len([error for error in tree.all_errors if error.startswith("US29")]), 1)
+        self.assertEqual(len([error for error in tree.all_errors if error.startswith("US31")]), 5)
+        tree = AnalyzeGEDCOM(self.file_name, False, False, stories = {"US29", "US31"}, as_of = self.as_of, limits = {"US29": 0})
+        self.assertEqual([error for error in tree.all_errors if error.startswith("US29")], [])
+        self.assertEqual(len([error for error in tree.all_errors if error.startswith("US31")]), 5)
+        self.assertFalse(tree.budget_exhausted)             #US29 was not run at all
+
+
+class MalformedInputTest(unittest.TestCase):
+    """Tests that malformed lines and dangling pointers are reported instead of stopping the run"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Bad_GEDCOM_test_data.ged")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def parse(self, text, create_tables = False, stories = set()):
+        """Parses the text as a GEDCOM file, by default without running the user stories"""
+        file_name = os.path.join(self.directory.name, "messy.ged")
+        with open(file_name, "w") as fp:
+            fp.write(text)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return AnalyzeGEDCOM(file_name, create_tables, False, stories = stories)
+
+    def test_resynchronize(self):
+        """Tests that the rest of a record with a malformed line is skipped and parsing goes on at the next record"""
+        tree = self.parse("0 HEAD\n\n0 @I1@ INDI\n1 NAME Ann /Lee/\n1 BIRT\n2 DATE 1 JAN 1950\n1 DEAT\n3 DATE 1 JAN 2000\n1 SEX F\n"
+                          "0 @I2@\n1 NAME Lost /Record/\n"
+                          "0 @I3@ INDI\n1 NAME Bob /Lee/\nx BIRT\n1 SEX M\n"
+                          "0 @I4@ INDI\n1 NAME Cal /Lee/\n1\n"
+                          "0 @I5@ INDI\n1 NAME Dee /Lee/\n   \n1 BIRT\n2 DATE 12 FOO 1990\n"
+                          "0 @I6@ INDI\n1 NAME Eve /Lee/\n1 BIRT\n2 DATE 5 MAY 1985\n1 FAMS @F9@\n0 TRLR\n")
+        self.assertEqual(tree.malformed_lines, 4)
+        self.assertEqual([number for number, text in tree.malformed_samples], [8, 10, 14, 18])
+        self.assertEqual(tree.malformed_samples[1], (10, "0 @I2@"))
+        self.assertEqual(tree.individuals["I1"].birt, datetime.date(1950, 1, 1))
+        self.assertEqual((tree.individuals["I1"].deat, tree.individuals["I1"].sex), (None, None))  #skipped after the level jump
+        self.assertIsNone(tree.individuals["I3"].birt)               #no birth date, reported and kept
+        self.assertIn("US27: Improper records of birth/death for Bob /Lee/, need proper birth/death date to calculate age", tree.errors)
+        self.assertIn("US42: 12 FOO 1990 is an illegitimate date for Dee /Lee/'s birthday. The date could not be read and was left out.", tree.errors)
+        self.assertIn("US26: The family F9 that I6 is a spouse in does not exist", tree.errors)
+        self.assertEqual(tree.individuals["I6"].fams, set())
+
+    def test_dangling_spouse(self):
+        """Tests that a spouse who does not exist is reported and dropped while the family is kept"""
+        tree = self.parse("0 @I1@ INDI\n1 NAME Ann /Lee/\n1 BIRT\n2 DATE 1 JAN 1950\n1 FAMS @F1@\n"
+                          "0 @F1@ FAM\n1 HUSB @I7@\n1 WIFE @I1@\n1 CHIL @I8@\n1 MARR\n2 DATE 31 FEB 1970\n0 TRLR\n", create_tables = True)
+        self.assertEqual((tree.family["F1"].husb, tree.family["F1"].wife, tree.family["F1"].chil), (None, "I1", set()))
+        self.assertEqual(tree.individuals["I1"].fams, {"F1"})
+        self.assertEqual(tree.errors, ["US42: 31 FEB 1970 is an illegitimate date for I7's and Ann /Lee/'s marriage. The date has been adjusted to the nearest valid date.",
+                                       "US26: The husband I7 of family F1 does not exist",
+                                       "US26: The child I8 of family F1 does not exist"])
+
+    def test_far_off_day(self):
+        """Tests that a day far outside its month is moved to the nearest valid day at once"""
+        tree = self.parse("0 @I1@ INDI\n1 NAME Ann /Lee/\n1 BIRT\n2 DATE 3000000 JAN 2000\n1 DEAT\n2 DATE -3000000 FEB 2001\n0 TRLR\n")
+        self.assertEqual((tree.individuals["I1"].birt, tree.individuals["I1"].deat), (datetime.date(2000, 1, 31), datetime.date(2001, 2, 1)))
+
+    def test_missing_birth_and_spouse(self):
+        """Tests that a spouse without a birth date and a family without a husband are kept and checked without false findings"""
+        file_name = os.path.join(self.directory.name, "partial.ged")
+        with open(file_name, "w") as fp:
+            fp.write("0 @I1@ INDI\n1 NAME Dad /B/\n1 SEX M\n1 FAMS @F1@\n"
+                     "0 @I2@ INDI\n1 NAME Mom /B/\n1 SEX F\n1 BIRT\n2 DATE 1 JAN 1950\n1 FAMS @F1@\n"
+                     "0 @I3@ INDI\n1 NAME C /B/\n1 BIRT\n2 DATE 1 JAN 2000\n1 FAMC @F1@\n"
+                     "0 @I4@ INDI\n1 NAME Solo /D/\n1 SEX F\n1 BIRT\n2 DATE 1 JAN 1960\n1 FAMS @F2@\n"
+                     "0 @I5@ INDI\n1 NAME Kid /D/\n1 BIRT\n2 DATE 1 JAN 2005\n1 FAMC @F2@\n"
+                     "0 @F1@ FAM\n1 HUSB @I1@\n1 WIFE @I2@\n1 CHIL @I3@\n1 MARR\n2 DATE 1 JUN 1970\n"
+                     "0 @F2@ FAM\n1 WIFE @I4@\n1 CHIL @I5@\n1 DIV\n2 DATE 1 JUN 2005\n0 TRLR\n")
+        with contextlib.redirect_stdout(io.StringIO()):
+            tree = AnalyzeGEDCOM(file_name, True, False, as_of = datetime.date(2018, 11, 15))
+        self.assertEqual((sorted(tree.individuals), sorted(tree.family)), (["I1", "I2", "I3", "I4", "I5"], ["F1", "F2"]))
+        self.assertEqual((tree.individuals["I3"].famc, tree.individuals["I5"].famc), ("F1", "F2"))
+        self.assertEqual(tree.all_errors, ["US27: Improper records of birth/death for Dad /B/, need proper birth/death date to calculate age",
+                                           "US30: Solo /D/ is alive and married"])
+
+    def test_fuzz(self):
+        """Randomly damages the test file and checks that parsing and the user stories never fail and leave no dangling pointers"""
+        with open(self.file_name) as fp:
+            original = fp.read().splitlines()
+        rng = random.Random(555)
+        garbage = ["", "   ", "0", "0 @X1@", "1", "7 DATE", "x NAME y", "2 DATE 99 ZZZ 0", "1 CHIL @I0@", "1 FAMC @F0@", "\u00e9\u00e8 \u00ff", "0 @F99@ FAM"]
+        for attempt in range(40):
+            lines = list(original)
+            for change in range(rng.randint(1, 25)):
+                position = rng.randrange(len(lines))
+                kind = rng.randrange(4)
+                if kind == 0:
+                    del lines[position]
+                elif kind == 1:
+                    lines.insert(position, rng.choice(garbage))
+                elif kind == 2:
+                    lines[position] = lines[position][:rng.randrange(len(lines[position]) + 1)]
+                else:
+                    lines[position] = " ".join(reversed(lines[position].split(" ", 2)))
+            tree = self.parse("\n".join(lines) + "\n", create_tables = True, stories = None)
+            for fam in tree.family.values():
+                self.assertTrue(({fam.husb, fam.wife} - {None}) | fam.chil <= set(tree.individuals))
+            for indi in tree.individuals.values():
+                self.assertTrue(indi.fams | ({indi.famc} - {None}) <= set(tree.family))
+            self.assertLessEqual(len(tree.malformed_samples), AnalyzeGEDCOM.MALFORMED_SAMPLES)
+        tree = self.parse("0 @I1@ INDI\n1 NAME Ann /Lee/\n1 BIRT\n2 DATE 1 JAN 1950\n1 FAMS @F1@\n1 FAMC @F1@\n"
+                          "0 @F1@ FAM\n1 WIFE @I1@\n1 CHIL @I1@\n0 TRLR\n", stories = None)     #Ann is a child of her own family
+        self.assertIn("US17: Ann /Lee/ cannot be married to their descendant Ann /Lee/", tree.all_errors)
+
+
+class TreeIndexTest(unittest.TestCase):
+    """Tests the secondary indexes for name and date range queries"""
+
+    def setUp(self):
+        file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Bad_GEDCOM_test_data.ged")
+        self.tree = AnalyzeGEDCOM(file_name, False, False, stories = set())
+        self.index = self.tree.build_indexes()
+
+    def test_date_ranges(self):
+        """Tests that the date queries return the same IDs as a scan of every record"""
+        start, end = datetime.date(1960, 1, 1), datetime.date(1980, 12, 31)
+        self.assertEqual(sorted(self.index.born_between(start, end)),
+                         sorted(ID for ID, indi in self.tree.individuals.items() if start <= indi.birt <= end))
+        self.assertEqual(sorted(self.index.married_between(start, None)),
+                         sorted(ID for ID, fam in self.tree.family.items() if start <= fam.marr))
+        self.assertEqual(sorted(self.index.died_in(1980)),
+                         sorted(ID for ID, indi in self.tree.individuals.items() if indi.deat != None and indi.deat.year == 1980))
+        self.assertEqual(list(self.index.born_in(1500)), [])
+
+    def test_surnames(self):
+        """Tests that surnames are taken from the /Surname/ part of the name and normalized"""
+        self.assertEqual(TreeIndex.surname("John  /van  Old/ Jr"), "van old")
+        self.assertIsNone(TreeIndex.surname("John"))
+        names = [self.tree.individuals[ID].name for ID in self.index.with_surname("  SMITH ")]
+        self.assertEqual(sorted(names), ["Jen /Smith/", "Jess /Smith/", "Matt /Smith/"])
+
+class DayOfYearIndexTest(unittest.TestCase):
+    """Tests the day of year index used for birthdays and anniversaries (US39)"""
+
+    def test_leap_day_and_year_end(self):
+        """Tests that 29 FEB events are celebrated on 28 FEB in other years and windows wrap into the next year"""
+        index = DayOfYearIndex([("F1", datetime.date(1996, 2, 29)), ("F2", datetime.date(1990, 1, 3)), ("F3", datetime.date(1990, 12, 30))])
+        self.assertEqual(list(index.within(datetime.date(2019, 2, 20), 8)), [("F1", datetime.date(2019, 2, 28))])
+        self.assertEqual(list(index.within(datetime.date(2020, 2, 20), 8)), [])
+        self.assertEqual(list(index.within(datetime.date(2020, 2, 29), 0)), [("F1", datetime.date(2020, 2, 29))])
+        self.assertEqual(list(index.within(datetime.date(2019, 12, 25), 10)), [("F3", datetime.date(2019, 12, 30)), ("F2", datetime.date(2020, 1, 3))])
+
+    def test_matches_scan(self):
+        """Tests that the index finds the same events as checking every day of the window"""
+        rand = random.Random(555)
+        events = [("I{}".format(i), datetime.date(1900, 1, 1) + datetime.timedelta(days = rand.randrange(40000))) for i in range(60)]
+        index = DayOfYearIndex(events)
+        for _ in range(40):
+            start, days = datetime.date(2000, 1, 1) + datetime.timedelta(days = rand.randrange(10000)), rand.randrange(400)
+            expected = set()
+            for ID, event in events:
+                for offset in range(days + 1):
+                    day = start + datetime.timedelta(days = offset)
+                    leap_day = (event.month, event.day) == (2, 29) and (day.month, day.day) == (2, 28) and not DayOfYearIndex.is_leap(day.year)
+                    if day > event and ((event.month, event.day) == (day.month, day.day) or leap_day):
+                        expected.add(ID)
+                        break
+            self.assertEqual({ID for ID, day in index.within(start, days)}, expected)
+
+class AncestryIndexTest(unittest.TestCase):
+    """Tests the relationship calculator built on the ancestry index (US19 and US20 use it too)"""
+
+    def setUp(self):
+        #G1 and G2 have P1 and P2, P1 has C1 and C2 with S1 and C4 with S3, P2 has C3 with S2 and C3 has D1 with X
+        families = {"FG": ("G1", "G2", ["P1", "P2"]), "F1": ("P1", "S1", ["C1", "C2"]), "F2": ("S2", "P2", ["C3"]),
+                    "F3": ("C3", "X", ["D1"]), "F4": ("P1", "S3", ["C4"])}
+        self.individuals, self.family = dict(), dict()
+        for ID, (husb, wife, children) in families.items():
+            self.family[ID] = Family()
+            self.family[ID].husb, self.family[ID].wife, self.family[ID].chil = husb, wife, set(children)
+            for spouse in (husb, wife):
+                self.individuals.setdefault(spouse, Individual()).fams.add(ID)
+            for child in children:
+                self.individuals.setdefault(child, Individual()).famc = ID
+        self.ancestry = AncestryIndex(self.individuals, self.family)
+
+    def test_blood_relationships(self):
+        """Tests siblings, half-siblings, cousins, aunts/uncles and direct lines"""
+        pairs = [("C1", "C2"), ("C1", "C4"), ("C1", "C3"), ("C1", "D1"), ("D1", "C1"), ("C1", "P2"), ("P2", "C1"),
+                 ("C1", "G1"), ("G1", "D1"), ("D1", "G2"), ("P1", "D1")]
+        self.assertEqual([relationship.description for relationship in self.ancestry.relationships(pairs)],
+                         ["sibling", "half-sibling", "1st cousin", "1st cousin once removed", "1st cousin once removed",
+                          "aunt/uncle", "niece/nephew", "grandparent", "great-grandchild", "great-grandparent", "grandniece/nephew"])
+        self.assertEqual(self.ancestry.common_ancestor("D1", "C1")[1:], (3, 2))
+        self.assertEqual(self.ancestry.depth["D1"], 3)
+
+    def test_marriage_relationships(self):
+        """Tests spouses and in-laws"""
+        pairs = [("P1", "S1"), ("S1", "G1"), ("G1", "S1"), ("C1", "S3"), ("S3", "C1"), ("C1", "S2"), ("S1", "S2")]
+        self.assertEqual([relationship.description for relationship in self.ancestry.relationships(pairs)],
+                         ["spouse", "parent-in-law", "child-in-law", "step-parent", "step-child", "aunt/uncle-in-law", "unrelated"])
+
+    def test_search_limits(self):
+        """Tests the generation limit, blood lines and that the batch cache is dropped afterwards"""
+        self.assertEqual(self.ancestry.common_ancestor("D1", "C1", 5)[1:], (3, 2))
+        self.assertIsNone(self.ancestry.common_ancestor("D1", "C1", 4))
+        self.assertTrue(self.ancestry.same_line("D1", "C4"))
+        self.individuals["Z"] = Individual()
+        self.ancestry = AncestryIndex(self.individuals, self.family)
+        self.assertFalse(self.ancestry.same_line("Z", "C1"))
+        self.assertIsNone(self.ancestry.common_ancestor("Z", "C1"))
+        self.assertEqual(self.ancestry.generations("D1", 2), {"D1": 0, "C3": 1, "X": 1, "P2": 2, "S2": 2})
+        self.ancestry.relationships([("D1", "C1"), ("D1", "C2")])
+        self.assertEqual(self.ancestry.known, dict())
+
+class DatabaseTest(unittest.TestCase):
+    """Tests the SQLite backend and the user stories it answers with SQL"""
+
+    def setUp(self):
+        self.cwd = os.path.dirname(os.path.abspath(__file__))
+
+    def test_same_messages_as_check_for_errors(self):
+        """Tests that the SQL stories report exactly the messages CheckForErrors reports"""
+        stories = set(GedcomDatabase.RULES)
+        for file_name in ("Bad_GEDCOM_test_data.ged", "GEDCOM_FamilyTree.ged"):
+            file_name = os.path.join(self.cwd, file_name)
+            database = GedcomDatabase.from_gedcom(file_name, ":memory:")
+            self.assertEqual(sorted(database.check_for_errors()),
+                             sorted(AnalyzeGEDCOM(file_name, False, False, stories = stories).all_errors))
+            database.close()
+
+    def test_streaming_batches(self):
+        """Tests that loading a few records at a time gives the same database, duplicate IDs spread over batches included"""
+        file_name = os.path.join(self.cwd, "Bad_GEDCOM_test_data.ged")
+        database = GedcomDatabase.from_gedcom(file_name, ":memory:")
+        expected = sorted(database.check_for_errors())
+        database.close()
+        for batch_size in (1, 7):
+            database = GedcomDatabase.from_gedcom(file_name, ":memory:", batch_size)
+            self.assertEqual(sorted(database.check_for_errors()), expected)
+            self.assertEqual(database.query("SELECT COUNT(*) FROM families WHERE id = 'F1'"), [(1,)])   #F1 appears twice in the file
+            database.close()
+
+    def test_reopen(self):
+        """Tests that a saved database can be checked again without the GEDCOM file"""
+        with tempfile.TemporaryDirectory() as directory:
+            db_name = os.path.join(directory, "tree.db")
+            GedcomDatabase.from_gedcom(os.path.join(self.cwd, "Bad_GEDCOM_test_data.ged"), db_name).close()
+            database = GedcomDatabase(db_name)
+            all_errors = database.check_for_errors({"US11", "US18"})
+            database.close()
+        self.assertIn("US22: The family ID: F1, already exists, this ID is not unique", all_errors)
+        self.assertIn("US18: Gorl /Sib/ cannot be married to their sibling Boyle /Sib/", all_errors)
+        self.assertIn("US11: Jen /Smith/ is practing bigamy", all_errors)
+        with self.assertRaises(ValueError):
+            GedcomDatabase(":memory:").check_for_errors({"US19"})
+
+class GedcomDiffTest(unittest.TestCase):
+    """Tests the structural diff between two versions of a GEDCOM file"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.old_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Bad_GEDCOM_test_data.ged")
+        with open(self.old_file) as fp:
+            text = fp.read()
+        text = text.replace("2 DATE 8 FEB 1969", "2 DATE 8 FEB 1970")                         #Mark /Eff/ birthday changes
+        text = text.replace("1 NAME Troy /Johnson/\n1 SEX M", "1 SEX M\n1 NAME Troy /Johnson/")  #same fields in another order
+        start, end = text.index("0 @I99@ INDI"), text.index("0 @I101@ INDI")                 #Art and Ann /Versity/ are removed
+        text = text[:start] + text[end:]
+        start, end = text.index("0 @F38@ FAM"), text.index("0 NOTE This family is for invalid dates")
+        text = text[:start] + text[end:]
+        text = text.replace("0 TRLR", "") + "0 @I500@ INDI\n1 NAME New /Person/\n1 SEX F\n1 BIRT\n2 DATE 1 JAN 2000\n0 TRLR\n"
+        self.new_file = os.path.join(self.directory.name, "new.ged")
+        with open(self.new_file, "w") as fp:
+            fp.write(text)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_changes(self):
+        """Tests that added, removed and modified records and the modified fields are found, and field order is ignored"""
+        diff = GedcomDiff(self.old_file, self.new_file)
+        self.assertEqual(diff.added, {"I500": "INDI"})
+        self.assertEqual(diff.removed, {"I99": "INDI", "I100": "INDI", "F38": "FAM"})
+        self.assertEqual(diff.modified, {"I1": "INDI"})
+        self.assertEqual(diff.changes["I1"], ([(("BIRT", ""), ("BIRT.DATE", "8 FEB 1969"))], [(("BIRT", ""), ("BIRT.DATE", "8 FEB 1970"))]))
+        self.assertEqual(GedcomDiff(self.old_file, self.old_file).report(), ["The files have the same records"])
+
+    def test_moved_values(self):
+        """Tests that values moved between two lines with the same tag are found, the lines under each line are kept together"""
+        records = "0 @I1@ INDI\n1 NAME Ann /Lee/\n1 RESI\n2 DATE 1950\n2 PLAC {}\n1 RESI\n2 DATE 1960\n2 PLAC {}\n1 SOUR @S1@\n2 PAGE 12\n0 TRLR\n"
+        for name, places in (("old.ged", ("Boston", "Denver")), ("moved.ged", ("Denver", "Boston")), ("reordered.ged", ("Boston", "Denver"))):
+            with open(os.path.join(self.directory.name, name), "w") as fp:
+                text = records.format(*places)
+                fp.write(text.replace("2 DATE 1950\n2 PLAC Boston", "2 PLAC Boston\n2 DATE 1950") if name == "reordered.ged" else text)
+        old_file, new_file = os.path.join(self.directory.name, "old.ged"), os.path.join(self.directory.name, "moved.ged")
+        diff = GedcomDiff(old_file, new_file)
+        self.assertEqual(diff.modified, {"I1": "INDI"})
+        removed, added = diff.changes["I1"]
+        self.assertEqual(removed, [(("RESI", ""), ("RESI.DATE", "1950"), ("RESI.PLAC", "Boston")), (("RESI", ""), ("RESI.DATE", "1960"), ("RESI.PLAC", "Denver"))])
+        self.assertEqual(added, [(("RESI", ""), ("RESI.DATE", "1950"), ("RESI.PLAC", "Denver")), (("RESI", ""), ("RESI.DATE", "1960"), ("RESI.PLAC", "Boston"))])
+        self.assertIn("    + RESI.PLAC Denver", diff.report())
+        self.assertEqual(GedcomDiff(old_file, os.path.join(self.directory.name, "reordered.ged")).modified, {})
+
+    def test_revalidate(self):
+        """Tests that only the records connected to the changes are validated again"""
+        diff = GedcomDiff(self.old_file, self.new_file)
+        affected = diff.affected()
+        self.assertTrue({"I1", "I2", "F1", "I500"} <= affected)
+        self.assertNotIn("I23", affected)   #Matt /Smith/ is not connected to any change
+        all_errors = diff.revalidate()
+        self.assertIn("US29: Mark /Eff/ is deceased", all_errors)
+        self.assertNotIn("US11: Matt /Smith/ is practing bigamy", all_errors)
+        self.assertEqual([error for error in all_errors if error.startswith("US26")], [])   #records that were not read are not dangling
+        full_run = AnalyzeGEDCOM(self.new_file, create_tables = False, print_errors = False).all_errors
+        self.assertTrue(set(all_errors) <= set(full_run))   #the records around the affected ones are read but not reported on
+
+    def test_duplicates(self):
+        """Tests that unchanged records with the same name and birth date (US23) or spouses and marriage (US24) as a changed
+           record are checked again"""
+        people = "0 @I1@ INDI\n1 NAME Ann /Lee/\n1 BIRT\n2 DATE 1 JAN 1950\n1 FAMS @F1@\n0 @I2@ INDI\n1 NAME {}\n1 BIRT\n2 DATE {}\n1 FAMS @F2@\n" \
+                 "0 @I3@ INDI\n1 NAME Bob /Lee/\n1 BIRT\n2 DATE 1 JAN 1945\n1 FAMS @F1@\n1 FAMS @F2@\n" \
+                 "0 @F1@ FAM\n1 HUSB @I3@\n1 WIFE @I1@\n1 MARR\n2 DATE 1 JUN 1970\n0 @F2@ FAM\n1 HUSB @I3@\n1 WIFE @I2@\n1 MARR\n2 DATE 1 JUN 1970\n0 TRLR\n"
+        files = []
+        for name, person in (("old.ged", ("Cal /Lee/", "2 FEB 1952")), ("new.ged", ("Ann /Lee/", "01 JAN 1950"))):
+            files.append(os.path.join(self.directory.name, name))
+            with open(files[-1], "w") as fp:
+                fp.write(people.format(*person))
+        diff = GedcomDiff(*files)
+        self.assertEqual(diff.modified, {"I2": "INDI"})
+        self.assertEqual(diff.colliding, {"I1", "I2", "F1", "F2"})      #F2 now has the same spouse names and marriage as F1
+        all_errors = diff.revalidate({"US23", "US24"})
+        full_run = AnalyzeGEDCOM(files[1], create_tables = False, print_errors = False, stories = {"US23", "US24"}).all_errors
+        self.assertEqual(sorted(all_errors), sorted(full_run))
+        self.assertIn("US23: An idividual with the name: Ann /Lee/, and birthday: 1950-01-01, already exists!", all_errors)
+        self.assertEqual(GedcomDiff(*reversed(files)).colliding, {"I1", "F1"})  #they used to collide with I2 and F2
+
+    def test_affected_relatives(self):
+        """Tests that a changed birth date only marks the relatives the user stories compare it with"""
+        old_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "GEDCOM_FamilyTree.ged")
+        with open(old_file) as fp:
+            text = fp.read()
+        start = text.index("0 @I3@ INDI")
+        date = text.index("2 DATE", start)
+        new_file = os.path.join(self.directory.name, "tree.ged")
+        with open(new_file, "w") as fp:
+            fp.write(text[:date] + "2 DATE 3 MAR 1950" + text[text.index("\n", date):])
+        diff = GedcomDiff(old_file, new_file)
+        self.assertEqual(diff.modified, {"I3": "INDI"})
+        everything = set(diff.new_references)
+        affected = diff.affected()
+        self.assertIn("I3", affected)
+        self.assertTrue(len(affected) < len(everything))
+        self.assertTrue(diff.affected({"US01"}) < affected)   #no grandparents or descendants without US17, US19 and US20
+        self.assertTrue(diff.context(affected) < everything)
+
+class GedcomExtractTest(unittest.TestCase):
+    """Tests extracting the ancestors or descendants of individuals and couples into a new GEDCOM file"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Bad_GEDCOM_test_data.ged")
+        self.extractor = GedcomExtract(self.file_name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_reachable(self):
+        """Tests the records found in each direction with and without a depth limit"""
+        self.assertEqual(self.extractor.reachable(["I96"], "ancestors", 1), {"I96", "F36", "I94", "I98"})
+        self.assertEqual(self.extractor.reachable(["F31"], "descendants", 1), {"F31", "I85", "I86", "I87", "I88", "F32", "F33", "I93", "I97"})
+        self.assertEqual(self.extractor.reachable(["F31"], "descendants", 1, include_spouses = False), {"F31", "I85", "I86", "I87", "I88", "F32", "F33"})
+        self.assertTrue({"F37", "I95", "I96", "F34", "I89", "I90"} <= self.extractor.reachable(["F31"], "descendants"))
+        self.assertTrue({"I85", "I86", "I91", "I92"} <= self.extractor.reachable(["I96"], "ancestors"))
+        self.assertEqual(self.extractor.reachable(["I89"], "both", 1), {"I89", "F32", "I87", "I93", "F34", "I90"})
+        self.assertRaises(KeyError, self.extractor.reachable, ["I9999"])
+        self.assertRaises(ValueError, self.extractor.reachable, ["I89"], "sideways")
+
+    def test_extract(self):
+        """Tests that the extracted file only holds the reachable records and no pointers to records that were left out"""
+        output = os.path.join(self.directory.name, "branch.ged")
+        IDs = extract(self.file_name, output, ["F31"], "descendants", 1)
+        tree = AnalyzeGEDCOM(output, create_tables = False, print_errors = False, stories = set())
+        self.assertEqual(set(tree.individuals) | set(tree.family), IDs)
+        self.assertEqual(tree.errors, [])                   #no pointers to records that were left out
+        self.assertEqual(tree.family["F32"].chil, set())
+        self.assertEqual(tree.family["F31"].chil, {"I87", "I88"})
+        self.assertEqual(tree.individuals["I87"].famc, "F31")
+        extract(self.file_name, output, ["F31"], "descendants", 1, include_spouses = False)
+        with open(output) as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual((lines[0], lines[-1]), ("0 HEAD", "0 TRLR"))
+        self.assertIn("1 HUSB @I87@", lines)
+        self.assertNotIn("1 WIFE @I93@", lines)             #Dad /Two/ married into the family and is left out
+
+    def test_head_pointers(self):
+        """Tests that the records HEAD points to are kept, that HEAD loses pointers to left out records, and that
+           undecodable bytes do not stop the extraction"""
+        source = os.path.join(self.directory.name, "head.ged")
+        with open(source, "wb") as fp:
+            fp.write("\n".join(["0 HEAD", "1 SUBM @U1@", "1 NOTE @N1@", "1 _HOME @I2@", "0 @U1@ SUBM", "1 NAME Ann \xe9",
+                                "0 @N1@ NOTE Header note", "0 @I1@ INDI", "1 NAME A /B/", "0 @I2@ INDI", "1 NAME C /D/",
+                                "0 TRLR", ""]).encode("latin-1"))
+        output = os.path.join(self.directory.name, "branch.ged")
+        self.assertEqual(extract(source, output, ["I1"]), {"I1"})
+        with open(output) as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(lines[:3], ["0 HEAD", "1 SUBM @U1@", "1 NOTE @N1@"])
+        self.assertIn("0 @U1@ SUBM", lines)
+        self.assertIn("0 @N1@ NOTE Header note", lines)
+        self.assertNotIn("1 _HOME @I2@", lines)
+        self.assertNotIn("0 @I2@ INDI", lines)
+
+
+class StatisticsTest(unittest.TestCase):
+    """Tests the aggregate statistics and merging partial results"""
+
+    def setUp(self):
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        self.files = [os.path.join(cwd, "Bad_GEDCOM_test_data.ged"), os.path.join(cwd, "GEDCOM_FamilyTree.ged")]
+        self.individuals = {"I1": Individual(), "I2": Individual(), "I3": Individual(), "I4": Individual()}
+        for ID, name, birt, deat in (("I1", "Joe /Shmoe/", (1900, 5, 1), (1975, 4, 30)), ("I2", "Mary /Jones/", (1904, 1, 1), None),
+                                     ("I3", "Jim /Shmoe/", (1930, 2, 2), None), ("I4", "Ann /Shmoe/", (1932, 3, 3), (1990, 1, 1))):
+            indi = self.individuals[ID]
+            indi.name, indi.birt = name, datetime.date(*birt)
+            indi.deat = datetime.date(*deat) if deat != None else None
+        self.family = {"F1": Family()}
+        self.family["F1"].husb, self.family["F1"].wife, self.family["F1"].chil = "I1", "I2", {"I3", "I4"}
+        self.family["F1"].marr = datetime.date(1925, 5, 1)
+
+    def test_statistics(self):
+        """Tests every metric on a small tree"""
+        statistics = TreeStatistics.from_tree(self.individuals, self.family)
+        self.assertEqual(statistics.births, {1900: 2, 1930: 2})
+        self.assertEqual(statistics.deaths, {1970: 1, 1990: 1})
+        self.assertEqual(statistics.lifespans, {70: 1, 50: 1})     #Joe died the day before his 75th birthday
+        self.assertEqual(statistics.family_sizes, {2: 1})
+        self.assertEqual(statistics.surnames, {"shmoe": 3, "jones": 1})
+        self.assertAlmostEqual(statistics.mean_marriage_age(), 23.2, places = 1)
+        by_surname = TreeStatistics.from_tree(self.individuals, self.family, "surname")
+        self.assertEqual(by_surname["shmoe"].individuals, 3)
+        self.assertEqual(by_surname["shmoe"].families, 1)           #families go to the husband's group
+        self.assertEqual((by_surname["jones"].marriages, by_surname["jones"].families), (1, 0))
+        by_decade = TreeStatistics.from_tree(self.individuals, self.family, "decade")
+        self.assertEqual(sorted(by_decade), [1900, 1930])
+        self.assertEqual(by_decade[1930].marriages, 0)
+        self.assertRaises(ValueError, TreeStatistics.from_tree, self.individuals, self.family, "century")
+
+    def test_merge(self):
+        """Tests that the statistics of shards and files add up to the statistics of everything"""
+        whole = TreeStatistics.from_tree(self.individuals, self.family)
+        first = TreeStatistics.from_tree({"I1": self.individuals["I1"], "I2": self.individuals["I2"]}, {})
+        second = TreeStatistics.from_tree({"I3": self.individuals["I3"], "I4": self.individuals["I4"]}, {})
+        families = TreeStatistics()
+        families.add_family(self.family["F1"])
+        for spouse in ("I1", "I2"):
+            families.add_marriage(self.individuals[spouse], self.family["F1"])
+        self.assertEqual(sum([first, second, families]), whole)
+        combined = file_statistics(self.files)
+        self.assertEqual(combined, file_statistics(self.files[:1]) + file_statistics(self.files[1:]))
+        self.assertEqual(combined.individuals, sum(statistics.individuals for statistics in file_statistics(self.files, "decade").values()))
+        grouped = merge_groups(file_statistics(self.files[:1], "surname"), file_statistics(self.files[1:], "surname"))
+        self.assertEqual(grouped, file_statistics(self.files, "surname"))
+
+
+class ServerTest(unittest.IsolatedAsyncioTestCase):
+    """Tests the local validation service over localhost"""
+
+    async def asyncSetUp(self):
+        self.file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Bad_GEDCOM_test_data.ged")
+        self.service = GedcomServer(executor = ThreadPoolExecutor(2))
+        self.listener = await self.service.start("127.0.0.1", 0)
+        self.port = self.listener.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.listener.close()
+        await self.listener.wait_closed()
+        self.service.executor.shutdown()
+
+    async def get(self, target):
+        """Sends a GET request to the service and returns the status and the decoded JSON body"""
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(target).encode())
+        response = await reader.read()
+        writer.close()
+        head, body = response.split(b"\r\n\r\n", 1)
+        return int(head.split()[1]), json.loads(body)
+
+    async def test_validate_lookup_and_relatives(self):
+        """Tests that concurrent queries are answered from one parse of the file"""
+        (status, validate), (_, lookup), (_, relatives) = await asyncio.gather(
+            self.get("/validate?file={}&stories=US11".format(self.file_name)),
+            self.get("/lookup?file={}&id=I1".format(self.file_name)),
+            self.get("/relatives?file={}&id=I1".format(self.file_name)))
+        self.assertEqual(status, 200)
+        self.assertIn("US11: Matt /Smith/ is practing bigamy", validate["errors"])
+        self.assertNotIn("US29: Mark /Eff/ is deceased", validate["errors"])
+        self.assertEqual((lookup["name"], lookup["birt"], lookup["fams"]), ("Mark /Eff/", "1969-02-08", ["F1"]))
+        self.assertEqual(relatives["spouses"], ["I2"])
+        status, relationship = await self.get("/relationship?file={}&a=I89&b=I90&b=I87".format(self.file_name))
+        self.assertEqual([other["description"] for other in relationship["relationships"]], ["1st cousin", "parent"])
+        status, trees = await self.get("/trees")
+        self.assertEqual(len(trees["trees"]), 1)            #the records are only held by the worker cache
+        self.assertEqual(trees["used"], trees["results"] + trees["trees"][0]["size"])
+
+    async def test_errors(self):
+        """Tests that bad requests are answered with an error status instead of closing the service"""
+        self.assertEqual((await self.get("/lookup?file={}&id=I999".format(self.file_name)))[0], 404)
+        self.assertEqual((await self.get("/validate?file={}&stories=US99".format(self.file_name)))[0], 400)
+        status, gate = await self.get("/validate?file={}&fail_fast=1".format(self.file_name))
+        self.assertEqual((status, gate["budget_exhausted"]), (200, True))
+        self.assertEqual([error.split(":")[0] for error in gate["errors"]], ["US22"])    #parse errors count against the budget
+        self.assertEqual((await self.get("/validate?file=missing.ged"))[0], 404)
+        self.assertEqual((await self.get("/validate"))[0], 400)
+
+    async def test_results_budget(self):
+        """Tests that the validation results kept with a tree count against the memory budget and are capped"""
+        await self.get("/lookup?file={}&id=I1".format(self.file_name))
+        tree = self.service.cache.get(self.file_name)
+        size = tree.size
+        self.service.cache.MAX_RESULTS = 2
+        for story in ("US01", "US02", "US03"):
+            await self.get("/validate?file={}&stories={}".format(self.file_name, story))
+        self.assertEqual([key[0] for key in tree.results], [frozenset({"US02"}), frozenset({"US03"})])
+        self.assertGreater(tree.size, size)
+        self.assertEqual(self.service.cache.used, tree.size)
+
+    async def test_process_pool(self):
+        """Tests that the connections are closed when the work runs in worker processes"""
+        self.service.executor.shutdown()
+        self.service = GedcomServer(executor = ProcessPoolExecutor(2))
+        self.listener.close()
+        await self.listener.wait_closed()
+        self.listener = await self.service.start("127.0.0.1", 0)
+        self.port = self.listener.sockets[0].getsockname()[1]
+        for ID in ("I1", "I2"):
+            status, lookup = await asyncio.wait_for(self.get("/lookup?file={}&id={}".format(self.file_name, ID)), 30)
+            self.assertEqual((status, lookup["id"]), (200, ID))
+        status, validate = await asyncio.wait_for(self.get("/validate?file={}&stories=US11".format(self.file_name)), 30)
+        self.assertIn("US11: Matt /Smith/ is practing bigamy", validate["errors"])
+        status, relationship = await asyncio.wait_for(self.get("/relationship?file={}&a=I89&b=I90".format(self.file_name)), 30)
+        self.assertEqual(relationship["relationships"][0]["description"], "1st cousin")
+        self.assertEqual(self.service.worker_budget, self.service.memory_budget // 3)   #the event loop and 2 workers share the budget
+        status, trees = await self.get("/trees")
+        self.assertEqual({tree["file"] for tree in trees["trees"]}, {self.file_name})
+        self.assertEqual(trees["used"], trees["results"] + sum(tree["size"] for tree in trees["trees"]))
+
+    def test_memory_budget(self):
+        """Tests that the least recently used tree is evicted once the budget is used up"""
+        class Tree:
+            def __init__(self, file_name, size):
+                self.file_name, self.size, self.mtime = file_name, size, os.path.getmtime(file_name)
+        cache = TreeCache(100)
+        cache.add(Tree(self.file_name, 60))
+        cache.add(Tree(__file__, 60))
+        self.assertIsNone(cache.get(self.file_name))
+        self.assertIsNotNone(cache.get(__file__))
+        self.assertEqual(cache.used, 60)
+
 if __name__ == '__main__':
     unittest.main(exit=False, verbosity=2)